@@ -2,3 +2,5 @@ from .prod_search_dataset import ProdSearchDataset
 from .prod_search_dataloader import ProdSearchDataLoader
 from .item_pv_dataset import ItemPVDataset
 from .item_pv_dataloader import ItemPVDataloader
+from .epoch_pipeline import EpochPipeline, EpochSampler
+from .batch_sampler import BucketBatchSampler
@@ -1,4 +1,12 @@
 import torch
+import numpy as np
+
+def to_tensor(data):
+    if isinstance(data, np.ndarray): #share the memory of the array instead of copying it
+        if not data.flags.writeable: #e.g. a view of a shared memory array
+            data = np.array(data)
+        return torch.from_numpy(np.ascontiguousarray(data))
+    return torch.tensor(data)
 
 class ItemPVBatch(object):
     def __init__(self, query_word_idxs, target_prod_idxs,
@@ -15,11 +23,11 @@ class ItemPVBatch(object):
             self.to_tensor()
 
     def to_tensor(self):
-        self.query_word_idxs = torch.tensor(self.query_word_idxs)
-        self.target_prod_idxs = torch.tensor(self.target_prod_idxs)
-        self.candi_prod_idxs = torch.tensor(self.candi_prod_idxs)
-        self.u_item_idxs = torch.tensor(self.u_item_idxs)
-        self.pos_iword_idxs = torch.tensor(self.pos_iword_idxs)
+        self.query_word_idxs = to_tensor(self.query_word_idxs)
+        self.target_prod_idxs = to_tensor(self.target_prod_idxs)
+        self.candi_prod_idxs = to_tensor(self.candi_prod_idxs)
+        self.u_item_idxs = to_tensor(self.u_item_idxs)
+        self.pos_iword_idxs = to_tensor(self.pos_iword_idxs)
 
     def to(self, device):
         if device == "cpu":
@@ -113,11 +121,11 @@ class ProdSearchTestBatch(object):
         #self.user_idxs = torch.tensor(user_idxs)
         #self.target_prod_idxs = torch.tensor(target_prod_idxs)
         #self.candi_prod_idxs = torch.tensor(candi_prod_idxs)
-        self.query_word_idxs = torch.tensor(self.query_word_idxs)
-        self.candi_prod_ridxs = torch.tensor(self.candi_prod_ridxs)
-        self.candi_seg_idxs = torch.tensor(self.candi_seg_idxs)
-        self.candi_seq_user_idxs = torch.tensor(self.candi_seq_user_idxs)
-        self.candi_seq_item_idxs = torch.tensor(self.candi_seq_item_idxs)
+        self.query_word_idxs = to_tensor(self.query_word_idxs)
+        self.candi_prod_ridxs = to_tensor(self.candi_prod_ridxs)
+        self.candi_seg_idxs = to_tensor(self.candi_seg_idxs)
+        self.candi_seq_user_idxs = to_tensor(self.candi_seq_user_idxs)
+        self.candi_seq_item_idxs = to_tensor(self.candi_seq_item_idxs)
 
     def to(self, device):
         if device == "cpu":
@@ -165,26 +173,26 @@ class ProdSearchTrainBatch(object):
             self.to_tensor()
 
     def to_tensor(self):
-        self.query_word_idxs = torch.tensor(self.query_word_idxs)
-        self.pos_prod_ridxs = torch.tensor(self.pos_prod_ridxs)
-        self.pos_seg_idxs = torch.tensor(self.pos_seg_idxs)
-        self.pos_prod_rword_idxs = torch.tensor(self.pos_prod_rword_idxs)
-        self.neg_prod_ridxs = torch.tensor(self.neg_prod_ridxs)
-        self.neg_seg_idxs = torch.tensor(self.neg_seg_idxs)
+        self.query_word_idxs = to_tensor(self.query_word_idxs)
+        self.pos_prod_ridxs = to_tensor(self.pos_prod_ridxs)
+        self.pos_seg_idxs = to_tensor(self.pos_seg_idxs)
+        self.pos_prod_rword_idxs = to_tensor(self.pos_prod_rword_idxs)
+        self.neg_prod_ridxs = to_tensor(self.neg_prod_ridxs)
+        self.neg_seg_idxs = to_tensor(self.neg_seg_idxs)
         self.pos_prod_rword_masks = torch.ByteTensor(self.pos_prod_rword_masks)
-        self.pos_user_idxs = torch.tensor(self.pos_user_idxs)
-        self.neg_user_idxs = torch.tensor(self.neg_user_idxs)
-        self.pos_item_idxs = torch.tensor(self.pos_item_idxs)
-        self.neg_item_idxs = torch.tensor(self.neg_item_idxs)
+        self.pos_user_idxs = to_tensor(self.pos_user_idxs)
+        self.neg_user_idxs = to_tensor(self.neg_user_idxs)
+        self.pos_item_idxs = to_tensor(self.pos_item_idxs)
+        self.neg_item_idxs = to_tensor(self.neg_item_idxs)
         if self.neg_prod_rword_idxs is not None:
-            self.neg_prod_rword_idxs = torch.tensor(self.neg_prod_rword_idxs)
+            self.neg_prod_rword_idxs = to_tensor(self.neg_prod_rword_idxs)
         if self.neg_prod_rword_masks is not None:
             self.neg_prod_rword_masks = torch.ByteTensor(self.neg_prod_rword_masks)
         #for pvc
         if self.neg_prod_rword_idxs_pvc is not None:
-                self.neg_prod_rword_idxs_pvc = torch.tensor(self.neg_prod_rword_idxs_pvc)
+                self.neg_prod_rword_idxs_pvc = to_tensor(self.neg_prod_rword_idxs_pvc)
         if self.pos_prod_rword_idxs_pvc is not None:
-                self.pos_prod_rword_idxs_pvc = torch.tensor(self.pos_prod_rword_idxs_pvc)
+                self.pos_prod_rword_idxs_pvc = to_tensor(self.pos_prod_rword_idxs_pvc)
 
     def to(self, device):
         if device == "cpu":
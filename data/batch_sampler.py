@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from others.logging import logger
+
+class BucketBatchSampler(Sampler):
+    """ train batches of samples with the same sequence length (dataset.get_seq_lengths()),
+    each of at most token_budget sequence positions, instead of batch_size random samples;
+    the samples of each length and the batches are in random order every epoch
+    """
+    def __init__(self, dataset, token_budget, batch_size):
+        self.dataset = dataset
+        self.token_budget = token_budget
+        self.batch_size = batch_size #only to compare with the padding of random batches in the log
+
+    def get_bucket_batch_sizes(self, bucket_lengths):
+        return np.maximum(1, self.token_budget // np.maximum(1, bucket_lengths))
+
+    def padding_efficiency(self, seq_lengths, batches):
+        #the share of the sequence positions in the batches that are not padding
+        padded = sum(len(x) * seq_lengths[x].max() for x in batches)
+        return seq_lengths.sum() / float(max(padded, 1))
+
+    def __iter__(self):
+        seq_lengths = np.asarray(self.dataset.get_seq_lengths(), dtype=np.int64)
+        random_orders = torch.randperm(len(seq_lengths)).numpy()
+        orders = random_orders[np.argsort(seq_lengths[random_orders], kind='stable')] #random order within each length
+        sorted_lengths = seq_lengths[orders]
+        bucket_starts = np.flatnonzero(np.r_[True, sorted_lengths[1:] != sorted_lengths[:-1]])
+        bucket_ends = np.r_[bucket_starts[1:], len(orders)]
+        batch_sizes = self.get_bucket_batch_sizes(sorted_lengths[bucket_starts])
+        batches = []
+        for start, end, batch_size in zip(bucket_starts, bucket_ends, batch_sizes):
+            batches.extend(orders[i:min(i+batch_size, end)] for i in range(start, end, batch_size))
+        batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        random_batches = [random_orders[i:i+self.batch_size] for i in range(0, len(random_orders), self.batch_size)]
+        logger.info("Bucketed batches: %d, padding efficiency %.2f%% (%.2f%% with %d random batches of %d)" % (
+            len(batches), 100 * self.padding_efficiency(seq_lengths, batches),
+            100 * self.padding_efficiency(seq_lengths, random_batches), len(random_batches), self.batch_size))
+        epoch_data = getattr(self.dataset, "epoch_data", None) #the samples are tagged for pipelined epochs
+        for batch in batches:
+            if epoch_data is None:
+                yield batch.tolist()
+            else:
+                yield [(epoch_data, idx) for idx in batch.tolist()]
+
+    def __len__(self):
+        bucket_lengths, counts = np.unique(self.dataset.get_seq_lengths(), return_counts=True)
+        batch_sizes = self.get_bucket_batch_sizes(bucket_lengths)
+        return int(((counts + batch_sizes - 1) // batch_sizes).sum())
@@ -0,0 +1,134 @@
+import numpy as np
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from others.logging import logger
+from data.ragged_array import RaggedArray
+
+""" one-time conversion of the gzip text files into flat numpy arrays
+lines:         values (unicode array, one entry per line)
+ragged:        offsets (int64, line_count+1) + values (int32, or int64 if it does not fit)
+review_id_map: ori_line_ids (int64), the original line id of each review
+review_id:     user_idxs, prod_idxs, ori_line_ids, query_idxs (only lines ending with a query idx)
+word_counts:   counts (int64), occurrences of each word idx in the review texts of a split
+the cache of each file is a directory of .npy files plus meta.json recording the cache version
+and the size and mtime of the source file, so that it is rebuilt whenever either changes
+"""
+
+CACHE_VERSION = 1
+
+def get_cache_dir(fname, data_cache_dir=''):
+    if data_cache_dir == '':
+        return fname + ".npcache"
+    name = os.path.abspath(fname).strip(os.sep).replace(os.sep, '__')
+    return os.path.join(data_cache_dir, name + ".npcache")
+
+def source_meta(fname, kind):
+    stat = os.stat(fname)
+    return {"version": CACHE_VERSION, "kind": kind,
+            "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def load(fname, kind, data_cache_dir=''):
+    """ return a dict of memory-mapped arrays of fname, building the cache when it is stale """
+    cache_dir = get_cache_dir(fname, data_cache_dir)
+    meta = source_meta(fname, kind)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as fin:
+            cache_meta = json.load(fin)
+        if cache_meta.get("meta") == meta:
+            return {x:np.load(os.path.join(cache_dir, x + ".npy"), mmap_mode='r') for x in cache_meta["arrays"]}
+    arrays = PARSERS[kind](fname)
+    try:
+        save(cache_dir, meta, arrays)
+    except OSError as e: #e.g. read-only data directory
+        logger.warning("Cannot write data cache {}: {}".format(cache_dir, e))
+    return arrays
+
+def save(cache_dir, meta, arrays):
+    parent_dir = os.path.dirname(os.path.abspath(cache_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp_npcache")
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), arr)
+        with open(os.path.join(tmp_dir, "meta.json"), 'w') as fout:
+            json.dump({"meta": meta, "arrays": sorted(arrays.keys())}, fout)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+    logger.info("Data cache written to {}".format(cache_dir))
+
+def int_array(values):
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+        values = values.astype(np.int32)
+    return values
+
+def arrays_to_ragged(arrays):
+    return RaggedArray(arrays["offsets"], arrays["values"])
+
+def parse_lines(fname):
+    arr = []
+    with gzip.open(fname, 'rt') as fin:
+        for line in fin:
+            arr.append(line.strip())
+    return {"values":np.asarray(arr, dtype=np.str_)}
+
+def parse_ragged(fname):
+    line_arr = []
+    with gzip.open(fname, 'rt') as fin:
+        for line in fin:
+            line_arr.append([int(x) for x in line.strip().split(' ') if len(x) > 0])
+    ragged_arr = RaggedArray.from_lists(line_arr)
+    return {"offsets":ragged_arr.offsets, "values":ragged_arr.values}
+
+def parse_review_id_map(fname):
+    ori_line_ids = []
+    with gzip.open(fname, 'rt') as fin:
+        for line in fin:
+            ori_line_ids.append(int(line.strip().split('_')[-1]))
+    return {"ori_line_ids":np.asarray(ori_line_ids, dtype=np.int64)}
+
+def parse_review_id(fname):
+    user_idxs, prod_idxs, ori_line_ids, query_idxs = [], [], [], []
+    with gzip.open(fname, 'rt') as fin:
+        for line in fin:
+            arr = line.strip().split('\t')
+            user_idxs.append(int(arr[0]))
+            prod_idxs.append(int(arr[1]))
+            ori_line_ids.append(int(arr[2].split('_')[-1]))
+            if arr[-1].isdigit():
+                query_idxs.append(int(arr[-1]))
+    return {"user_idxs":int_array(user_idxs), "prod_idxs":int_array(prod_idxs),
+            "ori_line_ids":np.asarray(ori_line_ids, dtype=np.int64), "query_idxs":int_array(query_idxs)}
+
+def add_word_counts(counts, word_idxs):
+    word_counts = np.bincount(np.asarray(word_idxs, dtype=np.int64))
+    if len(word_counts) > len(counts):
+        counts = np.pad(counts, (0, len(word_counts) - len(counts)), mode='constant')
+    counts[:len(word_counts)] += word_counts
+    return counts
+
+def parse_word_counts(fname):
+    counts = np.zeros(0, dtype=np.int64)
+    word_idxs = []
+    with gzip.open(fname, 'rt') as fin:
+        for line in fin:
+            arr = line.strip().split('\t')
+            word_idxs.extend(int(i) for i in arr[2].split(' '))
+            if len(word_idxs) >= 1000000: #count in chunks to bound the memory
+                counts = add_word_counts(counts, word_idxs)
+                word_idxs = []
+    counts = add_word_counts(counts, word_idxs)
+    return {"counts":counts}
+
+PARSERS = {"lines":parse_lines, "ragged":parse_ragged,
+           "review_id_map":parse_review_id_map, "review_id":parse_review_id,
+           "word_counts":parse_word_counts}
@@ -3,7 +3,10 @@ import numpy as np
 
 from others.logging import logger, init_logger
 from collections import defaultdict
+from data.ragged_array import RaggedArray
+from data.shared_array import SharedArrayStore
 import others.util as util
+import data.data_cache as data_cache
 import gzip
 import os
 
@@ -25,13 +28,13 @@ class ProdSearchData():
             self.subsampling_rate = 0
         if set_name == "train":
             self.vocab_distribute = self.read_reviews("{}/{}.txt.gz".format(input_train_dir, set_name))
-            self.vocab_distribute = self.vocab_distribute.tolist()
             self.sub_sampling(self.subsampling_rate)
             self.word_dists = self.neg_distributes(self.vocab_distribute)
 
         if set_name == "train":
             self.product_query_idx = GlobalProdSearchData.read_arr_from_lines(
                      "{}/{}_query_idx.txt.gz".format(input_train_dir, set_name))
+            self.product_query_seq = RaggedArray.from_lists(self.product_query_idx) #for sampling queries with arrays
             self.review_info = global_data.train_review_info
             self.review_query_idx = global_data.train_query_idxs
         else:
@@ -52,6 +55,8 @@ class ProdSearchData():
         #self.u_reviews, self.p_reviews = self.get_u_i_reviews(
         self.u_reviews, self.p_reviews = self.get_u_i_reviews_set(
                 self.user_size, self.product_size, global_data.train_review_info)
+        self.u_train_review_seq, self.u_train_review_pos, \
+                self.p_train_review_seq, self.p_train_review_pos = self.get_u_i_train_review_seq(global_data)
 
         if args.prod_freq_neg_sample:
             self.product_distribute = self.collect_product_distribute(global_data.train_review_info)
@@ -62,6 +67,21 @@ class ProdSearchData():
 
         self.set_review_size = len(self.review_info)
             #u:reviews i:reviews
+        if global_data.shared_store is not None:
+            self.share_memory()
+
+    def share_memory(self):
+        #the arrays read by the dataloader workers
+        share_array = self.global_data.share_array
+        if self.set_name == "train":
+            self.product_query_seq = share_array(self.product_query_seq)
+            self.sub_sampling_rate = share_array(self.sub_sampling_rate)
+            self.word_dists = share_array(self.word_dists)
+        self.u_train_review_seq = share_array(self.u_train_review_seq)
+        self.u_train_review_pos = share_array(self.u_train_review_pos)
+        self.p_train_review_seq = share_array(self.p_train_review_seq)
+        self.p_train_review_pos = share_array(self.p_train_review_pos)
+        self.product_dists = share_array(self.product_dists)
 
     def read_ranklist(self, fname, product_asin2ids):
         uq_pids = defaultdict(list)
@@ -89,67 +109,101 @@ class ProdSearchData():
             p_reviews[p_idx].add(r_idx)
         return u_reviews, p_reviews
 
+    def get_u_i_train_review_seq(self, global_data):
+        #train reviews of each user and item in the order of u_r_seq/i_r_seq,
+        #and the position of each train review in them (-1 for other reviews)
+        train_review_info = np.asarray(global_data.train_review_info, dtype=np.int64).reshape(-1, 4)
+        review_users = np.full(global_data.review_count, -1, dtype=np.int64)
+        review_users[train_review_info[:,3]] = train_review_info[:,1]
+        review_prods = np.full(global_data.review_count, -1, dtype=np.int64)
+        review_prods[train_review_info[:,3]] = train_review_info[:,2]
+        u_train_review_seq, u_train_review_pos = self.filter_review_seq(global_data.u_r_seq, review_users)
+        p_train_review_seq, p_train_review_pos = self.filter_review_seq(global_data.i_r_seq, review_prods)
+        return u_train_review_seq, u_train_review_pos, p_train_review_seq, p_train_review_pos
+
+    def filter_review_seq(self, review_seq, review_owners):
+        #keep the reviews in row i of review_seq that are train reviews of i
+        row_idxs = np.repeat(np.arange(len(review_seq)), review_seq.lengths)
+        train_review_seq = review_seq.filter(review_owners[review_seq.values] == row_idxs)
+        review_pos = np.full(len(review_owners), -1, dtype=np.int64)
+        seq_lengths = train_review_seq.lengths
+        review_pos[train_review_seq.values] = np.arange(len(train_review_seq.values)) \
+                - np.repeat(train_review_seq.offsets[:-1], seq_lengths)
+        return train_review_seq, review_pos
+
+    def get_user_train_review_idxs(self, user_idx, review_idx=None, limit=-1):
+        return self.get_train_review_idxs(
+                self.u_train_review_seq, self.u_train_review_pos, user_idx, review_idx, limit)
+
+    def get_item_train_review_idxs(self, prod_idx, review_idx=None, limit=-1):
+        return self.get_train_review_idxs(
+                self.p_train_review_seq, self.p_train_review_pos, prod_idx, review_idx, limit)
+
+    def get_train_review_idxs(self, train_review_seq, train_review_pos, row, review_idx, limit):
+        #train reviews of the user/item in time order without review_idx, the last limit ones if limit > 0
+        review_idxs = train_review_seq[row]
+        start = 0
+        if limit > 0:
+            start = max(0, len(review_idxs) - limit - 1) #one more in case review_idx is removed
+        review_idxs = review_idxs[start:].tolist()
+        if review_idx is not None:
+            pos = train_review_pos[review_idx] - start
+            if 0 <= pos < len(review_idxs) and review_idxs[pos] == review_idx:
+                del review_idxs[pos]
+        if limit > 0:
+            review_idxs = review_idxs[-limit:]
+        return review_idxs
+
     def initialize_epoch(self):
         #self.neg_sample_products = np.random.randint(0, self.product_size, size = (self.set_review_size, self.neg_per_pos))
         #exlude padding idx
         if self.args.model_name == "item_transformer":
             return
-        self.neg_sample_products = np.random.choice(self.product_size,
-                size = (self.set_review_size, self.neg_per_pos), replace=True, p=self.product_dists)
+        self.neg_sample_products = self.global_data.share_array(np.random.choice(self.product_size,
+                size = (self.set_review_size, self.neg_per_pos), replace=True, p=self.product_dists))
         #do subsampling to self.global_data.review_words
         if self.args.do_subsample_mask:
             #self.global_data.set_padded_review_words(self.global_data.review_words)
             return
 
-        rand_numbers = np.random.random(sum(self.global_data.review_length))
-        updated_review_words = []
-        entry_id = 0
-        for review in self.global_data.review_words[:-1]:
-            filtered_review = []
-            for word_idx in review:
-                if rand_numbers[entry_id] > self.sub_sampling_rate[word_idx]:
-                    continue
-                filtered_review.append(word_idx)
-            updated_review_words.append(filtered_review)
-        updated_review_words.append([self.global_data.word_pad_idx])
-        updated_review_words = util.pad(updated_review_words,
+        #one random number per word; a word is kept when it is not larger than the word's sampling rate
+        review_words = self.global_data.review_words
+        rand_numbers = np.random.random(len(review_words.values))
+        keep_masks = rand_numbers <= self.sub_sampling_rate[review_words.values]
+        updated_review_words = review_words.filter(keep_masks)
+        review_lengths = self.global_data.get_padded_lengths(updated_review_words.lengths)
+        updated_review_words = updated_review_words.to_padded(
                 pad_id=self.global_data.word_pad_idx, width=self.args.review_word_limit)
-        self.global_data.set_padded_review_words(updated_review_words)
+        updated_review_words[-1] = self.global_data.word_pad_idx #the last row is the padding review
+        review_lengths[-1] = 0
+        self.global_data.set_padded_review_words(updated_review_words, review_lengths)
 
     def collect_product_distribute(self, review_info):
-        product_distribute = np.zeros(self.product_size)
-        for _, uid, pid, _ in review_info:
-            product_distribute[pid] += 1
-        return product_distribute
+        prod_idxs = np.fromiter((x[2] for x in review_info), dtype=np.int64, count=len(review_info))
+        return np.bincount(prod_idxs, minlength=self.product_size).astype(float)
 
     def read_reviews(self, fname):
+        #word counts of the training reviews, cached next to the split when use_data_cache is set
+        if self.global_data.use_data_cache:
+            word_counts = data_cache.load(fname, "word_counts", self.global_data.data_cache_dir)["counts"]
+        else:
+            word_counts = data_cache.parse_word_counts(fname)["counts"]
         vocab_distribute = np.zeros(self.vocab_size)
-        #review_info = []
-        with gzip.open(fname, 'rt') as fin:
-            for line in fin:
-                arr = line.strip().split('\t')
-                #review_info.append((int(arr[0]), int(arr[1]))) # (user_idx, product_idx)
-                review_text = [int(i) for i in arr[2].split(' ')]
-                for idx in review_text:
-                    vocab_distribute[idx] += 1
-        #return vocab_distribute, review_info
+        vocab_distribute[:len(word_counts)] = word_counts
         return vocab_distribute
 
     def sub_sampling(self, subsample_threshold):
-        self.sub_sampling_rate = np.asarray([1.0 for _ in range(self.vocab_size)])
+        self.sub_sampling_rate = np.ones(self.vocab_size)
         if subsample_threshold == 0.0:
             return
-        threshold = sum(self.vocab_distribute) * subsample_threshold
-        for i in range(self.vocab_size):
-            #vocab_distribute[i] could be zero if the word does not appear in the training set
-            if self.vocab_distribute[i] == 0:
-                self.sub_sampling_rate[i] = 0
-                #if this word does not appear in training set, set the rate to 0.
-                continue
-            self.sub_sampling_rate[i] = min(1.0, (np.sqrt(float(self.vocab_distribute[i]) / threshold) + 1) * threshold / float(self.vocab_distribute[i]))
-
-        self.sample_count = sum([self.sub_sampling_rate[i] * self.vocab_distribute[i] for i in range(self.vocab_size)])
-        self.sub_sampling_rate = np.asarray(self.sub_sampling_rate)
+        vocab_distribute = np.asarray(self.vocab_distribute, dtype=float)
+        threshold = vocab_distribute.sum() * subsample_threshold
+        #if a word does not appear in the training set, its rate is 0
+        appeared = vocab_distribute > 0
+        self.sub_sampling_rate = np.zeros(self.vocab_size)
+        word_counts = vocab_distribute[appeared]
+        self.sub_sampling_rate[appeared] = np.minimum(1.0, (np.sqrt(word_counts / threshold) + 1) * threshold / word_counts)
+        self.sample_count = (self.sub_sampling_rate * vocab_distribute).sum()
         logger.info("sample_count:{}".format(self.sample_count))
 
     def neg_distributes(self, weights, distortion = 0.75):
@@ -161,51 +215,163 @@ class ProdSearchData():
         wf = wf / wf.sum()
         return wf
 
+    def sample_valid_candidates(self, target_prod_idxs, candi_size, chunk_elements=1<<24):
+        """ (len(target_prod_idxs), candi_size) int32 candidates, each row candi_size-1 products drawn from
+        product_dists without replacement plus the target product, in random order.
+        Gumbel top-k: the candi_size-1 largest log(p)+Gumbel noise keys are a weighted sample without replacement
+        """
+        pair_count = len(target_prod_idxs)
+        candidates = np.empty((pair_count, candi_size), dtype=np.int32)
+        candidates[:, -1] = target_prod_idxs
+        sample_size = candi_size - 1
+        with np.errstate(divide='ignore'):
+            log_dists = np.log(self.product_dists)
+        chunk_size = max(1, chunk_elements // self.product_size) #bound the size of the key matrix
+        for start in range(0, pair_count, chunk_size):
+            end = min(start + chunk_size, pair_count)
+            keys = log_dists - np.log(-np.log(np.random.random((end - start, self.product_size))))
+            sampled = np.argpartition(-keys, sample_size - 1, axis=1)[:, :sample_size]
+            candidates[start:end, :sample_size] = sampled
+        #shuffle the positions in each row so that the target is not always the last
+        orders = np.argsort(np.random.random((pair_count, candi_size)), axis=1)
+        return np.take_along_axis(candidates, orders, axis=1)
+
 
 class GlobalProdSearchData():
     def __init__(self, args, data_path, input_train_dir):
 
-        self.product_ids = self.read_lines("{}/product.txt.gz".format(data_path))
+        self.use_data_cache = args.use_data_cache
+        self.review_word_limit = args.review_word_limit
+        self.data_cache_dir = args.data_cache_dir
+        self.shared_store = SharedArrayStore(args.share_memory_dir) if args.share_memory else None
+        self.product_ids = self.load_lines("{}/product.txt.gz".format(data_path))
         self.product_asin2ids = {x:i for i,x in enumerate(self.product_ids)}
         self.product_size = len(self.product_ids)
-        self.user_ids = self.read_lines("{}/users.txt.gz".format(data_path))
+        self.user_ids = self.load_lines("{}/users.txt.gz".format(data_path))
         self.user_size = len(self.user_ids)
-        self.words = self.read_lines("{}/vocab.txt.gz".format(data_path))
+        self.words = self.load_lines("{}/vocab.txt.gz".format(data_path))
         self.vocab_size = len(self.words) + 1
-        self.query_words = self.read_words_in_lines("{}/query.txt.gz".format(input_train_dir))
+        self.query_words = self.load_arr_from_lines("{}/query.txt.gz".format(input_train_dir))
         self.word_pad_idx = self.vocab_size-1
-        self.query_words = util.pad(self.query_words, pad_id=self.word_pad_idx)
+        self.query_words = util.pad_array(self.query_words, pad_id=self.word_pad_idx)
 
         #review_word_limit = -1
         #if args.model_name == "review_transformer":
         #    self.review_word_limit = args.review_word_limit
-        self.review_words = self.read_words_in_lines(
+        self.review_words = self.load_ragged(
                 "{}/review_text.txt.gz".format(data_path)) #, cutoff=review_word_limit)
         #when using average word embeddings to train, review_word_limit is set
-        self.review_length = [len(x) for x in self.review_words]
+        self.review_length = self.review_words.lengths
         self.review_count = len(self.review_words) + 1
+        self.review_word_lengths = None #number of words in each row of review_words when it is padded
         if args.model_name == "review_transformer":
-            self.review_words.append([self.word_pad_idx]) # * args.review_word_limit)
+            self.review_words = self.review_words.append([self.word_pad_idx]) # * args.review_word_limit)
             #so that review_words[-1] = -1, ..., -1
             if args.do_subsample_mask:
-                self.review_words = util.pad(self.review_words, pad_id=self.vocab_size-1, width=args.review_word_limit)
+                self.review_word_lengths = self.get_padded_lengths(self.review_words.lengths)
+                self.review_word_lengths[-1] = 0
+                self.review_words = self.review_words.to_padded(pad_id=self.vocab_size-1, width=args.review_word_limit)
         #if args.do_seq_review_train or args.do_seq_review_test:
-        self.u_r_seq = self.read_arr_from_lines("{}/u_r_seq.txt.gz".format(data_path)) #list of review ids
-        self.i_r_seq = self.read_arr_from_lines("{}/p_r_seq.txt.gz".format(data_path)) #list of review ids
-        self.review_loc_time = self.read_arr_from_lines("{}/review_uloc_ploc_and_time.txt.gz".format(data_path)) #(loc_in_u, loc_in_i, time) of each review
+        self.u_r_seq = self.load_ragged("{}/u_r_seq.txt.gz".format(data_path)) #review ids of each user
+        self.i_r_seq = self.load_ragged("{}/p_r_seq.txt.gz".format(data_path)) #review ids of each item
+        self.review_loc_time = self.load_ragged(
+                "{}/review_uloc_ploc_and_time.txt.gz".format(data_path)).to_matrix() #(loc_in_u, loc_in_i, time) of each review
 
-        self.line_review_id_map = self.read_review_id_line_map("{}/review_id.txt.gz".format(data_path))
-        self.train_review_info, self.train_query_idxs = self.read_review_id(
+        self.line_review_id_map = self.load_review_id_line_map("{}/review_id.txt.gz".format(data_path))
+        self.train_review_info, self.train_query_idxs = self.load_review_id(
                 "{}/train_id.txt.gz".format(input_train_dir), self.line_review_id_map)
-        self.review_u_p = self.read_arr_from_lines("{}/review_u_p.txt.gz".format(data_path)) #list of review ids
+        self.review_u_p = self.load_ragged("{}/review_u_p.txt.gz".format(data_path)).to_matrix() #(user_idx, product_idx) of each review
 
         logger.info("Data statistic: vocab %d, review %d, user %d, product %d" % (self.vocab_size,
                     self.review_count, self.user_size, self.product_size))
         self.padded_review_words = None
+        self.padded_review_lengths = None
+        self.i_r_time_keys = None
+        if self.shared_store is not None:
+            self.share_memory()
+
+    def share_array(self, arr):
+        """ read-only shared memory copy of arr (or of the arrays of a RaggedArray) if share_memory is set """
+        if self.shared_store is None:
+            return arr
+        if isinstance(arr, RaggedArray):
+            return RaggedArray(self.shared_store.share(arr.offsets), self.shared_store.share(arr.values))
+        return self.shared_store.share(arr)
+
+    def share_memory(self):
+        #the arrays read by the dataloader workers, so that they are not copied into each worker;
+        #train_review_info becomes an array of (line_id, user_idx, prod_idx, review_idx) rows
+        self.query_words = self.share_array(self.query_words)
+        self.review_words = self.share_array(self.review_words)
+        self.review_length = self.share_array(self.review_length)
+        self.review_word_lengths = self.share_array(self.review_word_lengths)
+        self.u_r_seq = self.share_array(self.u_r_seq)
+        self.i_r_seq = self.share_array(self.i_r_seq)
+        self.review_loc_time = self.share_array(self.review_loc_time)
+        self.train_review_info = self.share_array(
+                np.asarray(self.train_review_info, dtype=np.int64).reshape(-1, 4))
+        self.review_u_p = self.share_array(self.review_u_p)
+        self.get_item_time_locs([], []) #build i_r_time_keys once instead of in each worker
+        self.i_r_time_keys = self.share_array(self.i_r_time_keys)
+
+    def set_padded_review_words(self, review_words, review_lengths=None):
+        self.padded_review_words = self.share_array(review_words)
+        self.padded_review_lengths = self.share_array(review_lengths)
+        #words after subsampling and cutoff and padding, and the number of words in each row
+
+    def get_padded_lengths(self, review_lengths):
+        #the number of words of each review left after cutting it to review_word_limit
+        if self.review_word_limit > 0:
+            return np.minimum(review_lengths, self.review_word_limit)
+        return review_lengths.copy()
+
+    def get_item_time_locs(self, prod_idxs, timestamps):
+        """ the number of reviews of each item in i_r_seq that are not later than the timestamp,
+        i.e. bisect_right over the review times of the item, for a batch of (item, timestamp)
+        """
+        if self.i_r_time_keys is None:
+            #review times of all the items flattened into one sorted array:
+            #item * time_stride + (time - min_time) for each review in i_r_seq
+            review_times = self.review_loc_time[self.i_r_seq.values, 2].astype(np.int64)
+            self.min_time = review_times.min() if len(review_times) > 0 else 0
+            self.max_time_offset = review_times.max() - self.min_time if len(review_times) > 0 else 0
+            self.time_stride = self.max_time_offset + 2 #so that a time before min_time stays in the item's range
+            item_idxs = np.repeat(np.arange(len(self.i_r_seq), dtype=np.int64), self.i_r_seq.lengths)
+            self.i_r_time_keys = item_idxs * self.time_stride + (review_times - self.min_time)
+        prod_idxs = np.asarray(prod_idxs, dtype=np.int64)
+        time_offsets = np.clip(np.asarray(timestamps, dtype=np.int64) - self.min_time, -1, self.max_time_offset)
+        locs = np.searchsorted(self.i_r_time_keys, prod_idxs * self.time_stride + time_offsets, side='right')
+        return locs - self.i_r_seq.offsets[prod_idxs]
+
+    #the load_* methods return the same as the read_* ones,
+    #but read from the numpy cache of the file when use_data_cache is set
+    def load_lines(self, fname):
+        if not self.use_data_cache:
+            return self.read_lines(fname)
+        return data_cache.load(fname, "lines", self.data_cache_dir)["values"].tolist()
+
+    def load_ragged(self, fname):
+        if not self.use_data_cache:
+            return RaggedArray.from_lists(self.read_arr_from_lines(fname))
+        return data_cache.arrays_to_ragged(data_cache.load(fname, "ragged", self.data_cache_dir))
+
+    def load_arr_from_lines(self, fname):
+        return self.load_ragged(fname).tolist()
+
+    def load_review_id_line_map(self, fname):
+        if not self.use_data_cache:
+            return self.read_review_id_line_map(fname)
+        ori_line_ids = data_cache.load(fname, "review_id_map", self.data_cache_dir)["ori_line_ids"]
+        return {x:i for i,x in enumerate(ori_line_ids.tolist())}
 
-    def set_padded_review_words(self, review_words):
-        self.padded_review_words = review_words
-        #words after subsampling and cutoff and padding
+    def load_review_id(self, fname, line_review_id_map):
+        if not self.use_data_cache:
+            return self.read_review_id(fname, line_review_id_map)
+        arrays = data_cache.load(fname, "review_id", self.data_cache_dir)
+        review_idxs = [line_review_id_map[x] for x in arrays["ori_line_ids"].tolist()]
+        review_info = list(zip(range(len(review_idxs)), arrays["user_idxs"].tolist(),
+            arrays["prod_idxs"].tolist(), review_idxs))
+        return review_info, arrays["query_idxs"].tolist()
 
     '''
     def read_review_loc_time(self, fname):
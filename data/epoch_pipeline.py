@@ -0,0 +1,116 @@
+import numpy as np
+import multiprocessing
+import random
+import torch
+from torch.utils.data import Sampler
+
+from data.shared_array import attach
+
+""" pipelined training epochs
+the train dataset of epoch n+1 (negative samples, subsampled review words, pv windows) is built
+in a background process while epoch n trains, and handed over as shared memory files;
+the dataloader keeps its workers across epochs and the workers switch to the arrays of a new
+epoch when its first samples arrive. each epoch is seeded with (seed, epoch), so the data of an
+epoch does not depend on when it was built
+"""
+
+#(owner, attribute) of the arrays that are rebuilt every epoch
+EPOCH_ARRAYS = (("prod_data", "neg_sample_products"), ("global_data", "padded_review_words"),
+                ("global_data", "padded_review_lengths"),
+                ("dataset", "train_word_idxs"), ("dataset", "train_review_idxs"))
+
+class EpochData(object):
+    """ the shared memory files of the arrays of an epoch """
+    def __init__(self, epoch, paths):
+        self.epoch = epoch
+        self.paths = paths
+
+    def install(self, dataset, shared_store=None):
+        #the owners are the objects of the process, i.e. the copies in a dataloader worker
+        owners = {"dataset":dataset, "global_data":dataset.global_data, "prod_data":dataset.prod_data}
+        for (owner, name), path in self.paths.items():
+            arr = attach(path) if shared_store is None else shared_store.adopt(path)
+            setattr(owners[owner], name, arr)
+        dataset.epoch_data = self
+
+def seed_epoch(args, epoch):
+    seed = (args.seed * 10007 + epoch) % (2**32)
+    np.random.seed(seed)
+    random.seed(seed)
+
+def build_epoch(args, ExpDataset, global_data, prod_data, epoch):
+    seed_epoch(args, epoch)
+    prod_data.initialize_epoch()
+    dataset = ExpDataset(args, global_data, prod_data)
+    owners = {"dataset":dataset, "global_data":global_data, "prod_data":prod_data}
+    paths = {}
+    for owner, name in EPOCH_ARRAYS:
+        arr = getattr(owners[owner], name, None)
+        if arr is not None:
+            paths[(owner, name)] = arr.shared_path
+    dataset.epoch_data = EpochData(epoch, paths)
+    return dataset
+
+def build_epoch_in_background(args, ExpDataset, global_data, prod_data, epoch, conn):
+    dataset = build_epoch(args, ExpDataset, global_data, prod_data, epoch)
+    conn.send(dataset.epoch_data)
+    conn.close()
+
+class EpochSampler(Sampler):
+    """ the samples of the current epoch of the dataset in random order,
+    each with the epoch data, so that the persistent workers switch to a new epoch
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __iter__(self):
+        epoch_data = self.dataset.epoch_data
+        for idx in torch.randperm(len(self.dataset)).tolist():
+            yield epoch_data, idx
+
+    def __len__(self):
+        return len(self.dataset)
+
+class EpochPipeline(object):
+    def __init__(self, args, ExpDataset, global_data, prod_data):
+        if global_data.shared_store is None:
+            raise ValueError("pipeline_epochs needs the data in shared memory (share_memory)")
+        self.args = args
+        self.ExpDataset = ExpDataset
+        self.global_data = global_data
+        self.prod_data = prod_data
+        self.dataset = None
+        self.process = None
+        self.conn = None
+        self.next_epoch = None
+
+    def get_dataset(self, epoch):
+        """ the train dataset of the epoch; the first epoch is built here since there is nothing to overlap it with """
+        if self.dataset is None:
+            self.dataset = build_epoch(self.args, self.ExpDataset, self.global_data, self.prod_data, epoch)
+            return self.dataset
+        if self.next_epoch != epoch:
+            raise ValueError("epoch {} is not being prepared".format(epoch))
+        try:
+            epoch_data = self.conn.recv()
+        except EOFError: #the process failed before sending the epoch
+            epoch_data = None
+        self.process.join()
+        exitcode = self.process.exitcode
+        self.conn.close()
+        self.process, self.conn, self.next_epoch = None, None, None
+        if epoch_data is None:
+            raise RuntimeError("preparing epoch {} failed (exit code {})".format(epoch, exitcode))
+        epoch_data.install(self.dataset, self.global_data.shared_store)
+        return self.dataset
+
+    def start(self, epoch):
+        """ build the train dataset of the epoch in a background process """
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=build_epoch_in_background,
+                args=(self.args, self.ExpDataset, self.global_data, self.prod_data, epoch, send_conn))
+        self.process.daemon = True
+        self.process.start()
+        send_conn.close()
+        self.conn = recv_conn
+        self.next_epoch = epoch
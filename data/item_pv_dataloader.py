@@ -4,17 +4,19 @@ import others.util as util
 import numpy as np
 import random
 from data.batch_data import ProdSearchTrainBatch, ProdSearchTestBatch, ItemPVBatch
+from data.ragged_array import RaggedArray
 
 
 class ItemPVDataloader(DataLoader):
     def __init__(self, args, dataset, prepare_pv=True, batch_size=1, shuffle=False, sampler=None,
                  batch_sampler=None, num_workers=0, pin_memory=False,
-                 drop_last=False, timeout=0, worker_init_fn=None):
+                 drop_last=False, timeout=0, worker_init_fn=None, persistent_workers=False):
         super(ItemPVDataloader, self).__init__(
             dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
             batch_sampler=batch_sampler, num_workers=num_workers,
             pin_memory=pin_memory, drop_last=drop_last, timeout=timeout,
-            worker_init_fn=worker_init_fn, collate_fn=self._collate_fn)
+            worker_init_fn=worker_init_fn, collate_fn=self._collate_fn,
+            persistent_workers=persistent_workers)
         self.args = args
         self.prod_pad_idx = self.dataset.prod_pad_idx
         self.word_pad_idx = self.dataset.word_pad_idx
@@ -23,6 +25,12 @@ class ItemPVDataloader(DataLoader):
         self.prod_data = self.dataset.prod_data
 
     def _collate_fn(self, batch):
+        if self.dataset.vectorized_collate: #batch is a list of sample indices
+            batch_idxs = np.asarray(batch, dtype=np.int64)
+            if self.prod_data.set_name == 'train':
+                return self.get_train_batch_arr(batch_idxs)
+            else:
+                return self.get_test_batch_arr(batch_idxs)
         if self.prod_data.set_name == 'train':
             return self.get_train_batch(batch)
         else: #validation or test
@@ -30,7 +38,7 @@ class ItemPVDataloader(DataLoader):
 
     def get_test_batch(self, batch):
         query_idxs = [entry[0] for entry in batch]
-        query_word_idxs = [self.global_data.query_words[x] for x in query_idxs]
+        query_word_idxs = self.global_data.query_words[query_idxs]
         user_idxs = [entry[1] for entry in batch]
         target_prod_idxs = [entry[2] for entry in batch]
         candi_prod_idxs = [entry[4] for entry in batch]
@@ -38,19 +46,41 @@ class ItemPVDataloader(DataLoader):
         for _, user_idx, prod_idx, review_idx, candidate_items in batch:
             do_seq = self.args.do_seq_review_test and not self.args.train_review_only
             u_prev_review_idxs = self.get_user_review_idxs(user_idx, review_idx, do_seq, fix=True)
-            u_item_idxs = [self.global_data.review_u_p[x][1] for x in u_prev_review_idxs]
+            u_item_idxs = self.global_data.review_u_p[u_prev_review_idxs, 1].tolist()
             candi_u_item_idxs.append(u_item_idxs)
 
-        candi_prod_idxs = util.pad(candi_prod_idxs, pad_id = self.prod_pad_idx)
-        candi_u_item_idxs = util.pad(candi_u_item_idxs, pad_id = self.prod_pad_idx)
+        candi_prod_idxs = util.pad_array(candi_prod_idxs, pad_id = self.prod_pad_idx)
+        candi_u_item_idxs = util.pad_array(candi_u_item_idxs, pad_id = self.prod_pad_idx)
 
         batch = ItemPVBatch(query_word_idxs, target_prod_idxs, candi_u_item_idxs,
                 query_idxs=query_idxs, user_idxs=user_idxs, candi_prod_idxs=candi_prod_idxs)
         return batch
 
+    def get_test_batch_arr(self, batch_idxs):
+        #same as get_test_batch, from the rows of the dataset
+        query_idxs, user_idxs, target_prod_idxs, review_idxs, candi_starts, candi_ends = self.dataset._data[batch_idxs].T
+        query_word_idxs = self.global_data.query_words[query_idxs]
+        candi_counts = candi_ends - candi_starts
+        width = candi_counts.max() if len(candi_counts) > 0 else 0
+        candi_locs = candi_starts[:,None] + np.arange(width)[None,:]
+        candi_masks = candi_locs < candi_ends[:,None]
+        candi_prod_idxs = np.full(candi_locs.shape, self.prod_pad_idx, dtype=np.int64)
+        if self.dataset.candi_pool is None: #ranges of product ids
+            candi_prod_idxs[candi_masks] = candi_locs[candi_masks]
+        else:
+            candi_prod_idxs[candi_masks] = self.dataset.candi_pool[candi_locs[candi_masks]]
+
+        do_seq = self.args.do_seq_review_test and not self.args.train_review_only
+        u_prev_review_idxs = self.get_user_review_idx_arr(user_idxs, review_idxs, do_seq, fix=True)
+        candi_u_item_idxs = self.get_review_item_matrix(u_prev_review_idxs)
+
+        batch = ItemPVBatch(query_word_idxs, target_prod_idxs, candi_u_item_idxs,
+                query_idxs=query_idxs.tolist(), user_idxs=user_idxs.tolist(), candi_prod_idxs=candi_prod_idxs)
+        return batch
+
     def get_test_batch_seq(self, batch):
         query_idxs = [entry[0] for entry in batch]
-        query_word_idxs = [self.global_data.query_words[x] for x in query_idxs]
+        query_word_idxs = self.global_data.query_words[query_idxs]
         user_idxs = [entry[1] for entry in batch]
         target_prod_idxs = [entry[2] for entry in batch]
         candi_prod_idxs = [entry[4] for entry in batch]
@@ -59,7 +89,7 @@ class ItemPVDataloader(DataLoader):
         for _, user_idx, prod_idx, review_idx, candidate_items in batch:
             do_seq = self.args.do_seq_review_test and not self.args.train_review_only
             u_prev_review_idxs = self.get_user_review_idxs(user_idx, review_idx, do_seq, fix=True)
-            u_item_idxs = [self.global_data.review_u_p[x][1] for x in u_prev_review_idxs]
+            u_item_idxs = self.global_data.review_u_p[u_prev_review_idxs, 1].tolist()
 
             candi_batch_item_idxs = []
             candi_batch_seg_idxs = []
@@ -71,11 +101,9 @@ class ItemPVDataloader(DataLoader):
             candi_seg_idxs.append(candi_batch_seg_idxs)
             candi_seq_item_idxs.append(candi_batch_item_idxs)
 
-        candi_prod_idxs = util.pad(candi_prod_idxs, pad_id = -1)
-        candi_seg_idxs = util.pad_3d(candi_seg_idxs, pad_id = self.seg_pad_idx, dim=1)
-        candi_seg_idxs = util.pad_3d(candi_seg_idxs, pad_id = self.seg_pad_idx, dim=2)
-        candi_seq_item_idxs = util.pad_3d(candi_seq_item_idxs, pad_id = self.prod_pad_idx, dim=1)
-        candi_seq_item_idxs = util.pad_3d(candi_seq_item_idxs, pad_id = self.prod_pad_idx, dim=2)
+        candi_prod_idxs = util.pad_array(candi_prod_idxs, pad_id = -1)
+        candi_seg_idxs = util.pad_3d_array(candi_seg_idxs, pad_id = self.seg_pad_idx)
+        candi_seq_item_idxs = util.pad_3d_array(candi_seq_item_idxs, pad_id = self.prod_pad_idx)
 
         batch = ItemPVBatch(query_word_idxs, target_prod_idxs, candi_prod_idxs, None,
                 candi_seg_idxs, None, candi_seq_item_idxs,
@@ -83,28 +111,39 @@ class ItemPVDataloader(DataLoader):
         return batch
 
     def get_user_review_idxs(self, user_idx, review_idx, do_seq, fix=True):
-        u_seq_review_idxs = self.global_data.u_r_seq[user_idx]
-        u_train_review_set = self.prod_data.u_reviews[user_idx] #set
         if do_seq:
             loc_in_u = self.global_data.review_loc_time[review_idx][0]
-            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u]
+            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u].tolist()
             u_prev_review_idxs = u_prev_review_idxs[-self.args.uprev_review_limit:]
+        elif fix:
+            u_prev_review_idxs = self.prod_data.get_user_train_review_idxs(
+                    user_idx, review_idx, limit=self.args.uprev_review_limit)
         else:
-            u_seq_train_review_idxs = [x for x in u_seq_review_idxs if x in u_train_review_set and x!= review_idx]
+            u_seq_train_review_idxs = self.prod_data.get_user_train_review_idxs(user_idx, review_idx)
             u_prev_review_idxs = u_seq_train_review_idxs
             if len(u_seq_train_review_idxs) > self.args.uprev_review_limit:
-                if fix:
-                    u_prev_review_idxs = u_seq_train_review_idxs[-self.args.uprev_review_limit:]
-                else:
-                    rand_review_set = random.sample(u_seq_train_review_idxs, self.args.uprev_review_limit)
-                    rand_review_set = set(rand_review_set)
-                    u_prev_review_idxs = [x for x in u_seq_train_review_idxs if x in rand_review_set]
+                rand_review_set = random.sample(u_seq_train_review_idxs, self.args.uprev_review_limit)
+                rand_review_set = set(rand_review_set)
+                u_prev_review_idxs = [x for x in u_seq_train_review_idxs if x in rand_review_set]
         return u_prev_review_idxs
 
+    def get_user_review_idx_arr(self, user_idxs, review_idxs, do_seq, fix=True):
+        #get_user_review_idxs for a batch, as a RaggedArray with one row per sample
+        if do_seq:
+            return self.global_data.u_r_seq.select(user_idxs, ends=self.global_data.review_loc_time[review_idxs, 0],
+                    limit=self.args.uprev_review_limit)
+        return self.prod_data.u_train_review_seq.select(user_idxs, limit=self.args.uprev_review_limit,
+                excludes=review_idxs, randomly=not fix)
+
+    def get_review_item_matrix(self, review_idx_arr):
+        #items of the reviews in each row, padded with prod_pad_idx
+        item_arr = RaggedArray(review_idx_arr.offsets, self.global_data.review_u_p[review_idx_arr.values, 1])
+        return item_arr.to_padded(pad_id=self.prod_pad_idx).astype(np.int64)
+
     def get_user_review_idxs_prev(self, user_idx, review_idx, do_seq, fix=True):
         if do_seq:
             loc_in_u = self.global_data.review_loc_time[review_idx][0]
-            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u]
+            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u].tolist()
             u_prev_review_idxs = u_prev_review_idxs[-self.args.uprev_review_limit:]
             #u_prev_review_idxs = self.global_data.u_r_seq[user_idx][max(0,loc_in_u-self.uprev_review_limit):loc_in_u]
         else:
@@ -127,19 +166,38 @@ class ItemPVDataloader(DataLoader):
         cur_no = 0
         for word_idxs, review_idx in batch:
             batch_word_idxs.append(word_idxs)
-            user_idx, prod_idx = self.global_data.review_u_p[review_idx]
+            user_idx, prod_idx = self.global_data.review_u_p[review_idx].tolist()
             query_idx = random.choice(self.prod_data.product_query_idx[prod_idx])
             query_word_idxs = self.global_data.query_words[query_idx]
 
             u_prev_review_idxs = self.get_user_review_idxs(
                     user_idx, review_idx, self.args.do_seq_review_train, fix=self.args.fix_train_review)
-            u_item_idxs = [self.global_data.review_u_p[x][1] for x in u_prev_review_idxs]
+            u_item_idxs = self.global_data.review_u_p[u_prev_review_idxs, 1].tolist()
             batch_query_word_idxs.append(query_word_idxs)
             batch_target_prod_idxs.append(prod_idx)
             batch_u_item_idxs.append(u_item_idxs)
 
-        batch_u_item_idxs = util.pad(batch_u_item_idxs, pad_id = self.prod_pad_idx)
-        batch = ItemPVBatch(batch_query_word_idxs, batch_target_prod_idxs, batch_u_item_idxs, batch_word_idxs)
+        batch_u_item_idxs = util.pad_array(batch_u_item_idxs, pad_id = self.prod_pad_idx)
+        batch_word_idxs = np.asarray(batch_word_idxs, dtype=np.int64)
+        batch = ItemPVBatch(np.asarray(batch_query_word_idxs), batch_target_prod_idxs, batch_u_item_idxs, batch_word_idxs)
+        return batch
+
+    def get_train_batch_arr(self, batch_idxs):
+        #same as get_train_batch, from the sample arrays of the dataset
+        batch_word_idxs = self.dataset.train_word_idxs[batch_idxs].astype(np.int64)
+        review_idxs = self.dataset.train_review_idxs[batch_idxs].astype(np.int64)
+        user_idxs, target_prod_idxs = self.global_data.review_u_p[review_idxs].astype(np.int64).T
+        #one random query of each target product
+        query_seq = self.prod_data.product_query_seq
+        query_starts = query_seq.offsets[target_prod_idxs]
+        query_counts = query_seq.offsets[target_prod_idxs+1] - query_starts
+        query_idxs = query_seq.values[query_starts + (np.random.random(len(batch_idxs)) * query_counts).astype(np.int64)]
+        query_word_idxs = self.global_data.query_words[query_idxs]
+
+        u_prev_review_idxs = self.get_user_review_idx_arr(
+                user_idxs, review_idxs, self.args.do_seq_review_train, fix=self.args.fix_train_review)
+        batch_u_item_idxs = self.get_review_item_matrix(u_prev_review_idxs)
+        batch = ItemPVBatch(query_word_idxs, target_prod_idxs, batch_u_item_idxs, batch_word_idxs)
         return batch
 
     def prepare_train_batch_pad_ui_seq(self, batch):
@@ -152,12 +210,12 @@ class ItemPVDataloader(DataLoader):
         cur_no = 0
         for word_idxs, review_idx in batch:
             batch_word_idxs.append(word_idxs)
-            user_idx, prod_idx = self.global_data.review_u_p[review_idx]
+            user_idx, prod_idx = self.global_data.review_u_p[review_idx].tolist()
             query_idx = random.choice(self.prod_data.product_query_idx[prod_idx])
             query_word_idxs = self.global_data.query_words[query_idx]
 
             u_prev_review_idxs = self.get_user_review_idxs(user_idx, review_idx, self.args.do_seq_review_train, fix=False)
-            u_item_idxs = [self.global_data.review_u_p[x][1] for x in u_prev_review_idxs]
+            u_item_idxs = self.global_data.review_u_p[u_prev_review_idxs, 1].tolist()
             pos_seq_item_idxs =  u_item_idxs + [prod_idx]
             pos_seg_idxs = [0] + [1] * len(u_prev_review_idxs) + [2]
             neg_seg_idxs = []
@@ -181,12 +239,12 @@ class ItemPVDataloader(DataLoader):
         query_word_idxs, pos_iword_idxs, pos_seg_idxs, neg_seg_idxs, \
                 pos_seq_item_idxs, neg_seq_item_idxs = self.prepare_train_batch(batch)
         target_prod_idxs = [x[-1] for x in pos_seq_item_idxs]
-        pos_seg_idxs = util.pad(pos_seg_idxs, pad_id = self.seg_pad_idx)
-        pos_seq_item_idxs = util.pad(pos_seq_item_idxs, pad_id = self.prod_pad_idx)
+        pos_seg_idxs = util.pad_array(pos_seg_idxs, pad_id = self.seg_pad_idx)
+        pos_seq_item_idxs = util.pad_array(pos_seq_item_idxs, pad_id = self.prod_pad_idx)
         batch_size, prev_item_count = np.asarray(pos_seq_item_idxs).shape
         #batch, neg_k, item_count
-        neg_seg_idxs = util.pad_3d(neg_seg_idxs, pad_id = self.seg_pad_idx, dim=2)
-        neg_seq_item_idxs = util.pad_3d(neg_seq_item_idxs, pad_id = self.prod_pad_idx, dim=2)
+        neg_seg_idxs = util.pad_3d_array(neg_seg_idxs, pad_id = self.seg_pad_idx)
+        neg_seq_item_idxs = util.pad_3d_array(neg_seq_item_idxs, pad_id = self.prod_pad_idx)
 
         batch = ItemPVBatch(query_word_idxs, target_prod_idxs, [], pos_seg_idxs,
                 neg_seg_idxs, pos_seq_item_idxs, neg_seq_item_idxs, pos_iword_idxs=pos_iword_idxs)
@@ -28,15 +28,32 @@ class ItemPVDataset(Dataset):
         self.uprev_review_limit = args.uprev_review_limit
         self.global_data = global_data
         self.prod_data = prod_data
+        self.epoch_data = None #set with pipeline_epochs
+        #samples are returned as their indices and the dataloader builds the batch from the arrays below
+        self.vectorized_collate = args.vectorized_collate
+        #all the products are candidates and the model can score them with one matrix multiply
+        self.catalog_topk = args.full_catalog_topk and prod_data.set_name != "train" \
+                and prod_data.uq_pids is None \
+                and not (prod_data.set_name == "valid" and self.valid_candi_size > 1) \
+                and (args.model_name != "item_transformer" or args.use_dot_prod)
         if prod_data.set_name == "train":
-            self._data = self.collect_train_samples(self.global_data, self.prod_data)
+            self.train_word_idxs, self.train_review_idxs = self.collect_train_samples(self.global_data, self.prod_data)
+            self.train_word_idxs = global_data.share_array(self.train_word_idxs)
+            self.train_review_idxs = global_data.share_array(self.train_review_idxs)
+            self._data = None
         else:
-            self._data = self.collect_test_samples(self.global_data, self.prod_data, args.candi_batch_size)
+            self._data, self.candi_pool = self.collect_test_samples(self.global_data, self.prod_data, args.candi_batch_size)
+            self._data = global_data.share_array(self._data)
+            self.candi_pool = global_data.share_array(self.candi_pool)
 
     def collect_test_samples(self, global_data, prod_data, candi_batch_size=1000):
         #Q, review of u + review of pos i, review of u + review of neg i;
         #words of pos reviews; words of neg reviews, all if encoder is not pv
-        test_data = []
+        #each row is (query_idx, user_idx, prod_idx, review_idx, candi_start, candi_end); the candidates are
+        #products candi_start to candi_end-1, or candi_pool[candi_start:candi_end] when candidates are
+        #sampled or read from a ranklist, and are only materialized in __getitem__
+        pairs = []
+        uq_candidates = []
         uq_set = set()
         for line_id, user_idx, prod_idx, review_idx in prod_data.review_info:
             if (line_id+1) % 10000 == 0:
@@ -48,52 +65,95 @@ class ItemPVDataset(Dataset):
                 if (user_idx, query_idx) in uq_set:
                     continue
                 uq_set.add((user_idx, query_idx))
-
-                #candidate item list according to user_idx and query_idx, or by default all the items
-                if prod_data.uq_pids is None:
-                    if self.prod_data.set_name == "valid" and self.valid_candi_size > 1:
-                        candidate_items = np.random.choice(global_data.product_size,
-                                size=self.valid_candi_size-1, replace=False, p=prod_data.product_dists).tolist()
-                        candidate_items.append(prod_idx)
-                        random.shuffle(candidate_items)
-                    else:
-                        candidate_items = list(range(global_data.product_size))
-                else:
-                    candidate_items = prod_data.uq_pids[(global_data.user_ids[user_idx], query_idx)]
+                pairs.append([query_idx, user_idx, prod_idx, review_idx])
+                if prod_data.uq_pids is not None:
+                    #candidate item list according to user_idx and query_idx
+                    candidate_items = list(prod_data.uq_pids[(global_data.user_ids[user_idx], query_idx)])
                     random.shuffle(candidate_items)
-                    #print(len(candidate_items))
-                seg_count = int((len(candidate_items) - 1) / candi_batch_size) + 1
-                for i in range(seg_count):
-                    test_data.append([query_idx, user_idx, prod_idx, review_idx,
-                        candidate_items[i*candi_batch_size:(i+1)*candi_batch_size]])
+                    uq_candidates.append(np.asarray(candidate_items, dtype=np.int32))
         print(len(uq_set))
-        return test_data
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 4)
+
+        candi_pool = None
+        if self.catalog_topk: #candidates are not materialized
+            candi_counts = np.zeros(len(pairs), dtype=np.int64)
+        elif prod_data.uq_pids is None and self.prod_data.set_name == "valid" and self.valid_candi_size > 1:
+            #all the candidate sets are sampled at once
+            candi_pool = prod_data.sample_valid_candidates(pairs[:,2], self.valid_candi_size).reshape(-1)
+            candi_counts = np.full(len(pairs), self.valid_candi_size, dtype=np.int64)
+        elif prod_data.uq_pids is None: #by default all the items
+            candi_counts = np.full(len(pairs), global_data.product_size, dtype=np.int64)
+        else:
+            candi_pool = np.concatenate(uq_candidates) if len(uq_candidates) > 0 else np.zeros(0, dtype=np.int32)
+            candi_counts = np.asarray([len(x) for x in uq_candidates], dtype=np.int64)
+        candi_starts = np.zeros(len(pairs), dtype=np.int64)
+        if candi_pool is not None:
+            candi_starts = np.cumsum(candi_counts) - candi_counts
+
+        #cut the candidates of each pair into segments of candi_batch_size, at least one segment per pair
+        seg_counts = np.maximum(candi_counts - 1, 0) // candi_batch_size + 1
+        seg_pair_idxs = np.repeat(np.arange(len(pairs)), seg_counts)
+        seg_nos = np.arange(len(seg_pair_idxs)) - np.repeat(np.cumsum(seg_counts) - seg_counts, seg_counts)
+        seg_starts = candi_starts[seg_pair_idxs] + seg_nos * candi_batch_size
+        seg_ends = np.minimum(seg_starts + candi_batch_size, (candi_starts + candi_counts)[seg_pair_idxs])
+        test_data = np.column_stack([pairs[seg_pair_idxs], seg_starts, seg_ends])
+        return test_data, candi_pool
 
 
     def collect_train_samples(self, global_data, prod_data):
         #Q, review of u + review of pos i, review of u + review of neg i;
         #words of pos reviews; words of neg reviews, all if encoder is not pv
-        train_data = []
-        rand_numbers = np.random.random(sum(global_data.review_length))
-        entry_id = 0
-        word_idxs = []
-        for line_no, user_idx, prod_idx, review_idx in prod_data.review_info:
-            cur_review_word_idxs = self.global_data.review_words[review_idx]
-            random.shuffle(cur_review_word_idxs)
-            for word_idx in cur_review_word_idxs:
-                if rand_numbers[entry_id] > prod_data.sub_sampling_rate[word_idx]:
-                    continue
-                word_idxs.append(word_idx)
-                if len(word_idxs) == self.pv_window_size:
-                    train_data.append([word_idxs, review_idx])
-                    word_idxs = []
-                entry_id += 1
-        if len(word_idxs) > 0:
-            train_data.append([word_idxs+[self.word_pad_idx]*(self.pv_window_size-len(word_idxs)), review_idx])
-        return train_data
+        #words of each train review in random order, subsampled and cut into windows of pv_window_size;
+        #a window may span reviews and belongs to the review of its last word
+        review_idxs = np.asarray([x[3] for x in prod_data.review_info], dtype=np.int64)
+        review_words = global_data.review_words
+        positions, lengths = review_words.gather_ranges(review_idxs)
+        word_idxs = review_words.values[positions]
+        token_review_idxs = np.repeat(review_idxs, lengths)
+        token_rows = np.repeat(np.arange(len(review_idxs)), lengths)
+        word_idxs = word_idxs[np.lexsort((np.random.random(len(word_idxs)), token_rows))] #shuffle within reviews
+        keep_masks = np.random.random(len(word_idxs)) <= prod_data.sub_sampling_rate[word_idxs]
+        word_idxs = word_idxs[keep_masks]
+        token_review_idxs = token_review_idxs[keep_masks]
+
+        window_count = int((len(word_idxs) - 1) / self.pv_window_size) + 1 if len(word_idxs) > 0 else 0
+        pad_size = window_count * self.pv_window_size - len(word_idxs)
+        word_idxs = np.concatenate([word_idxs, np.full(pad_size, self.word_pad_idx, dtype=word_idxs.dtype)])
+        word_idxs = word_idxs.reshape(window_count, self.pv_window_size)
+        window_review_idxs = token_review_idxs[self.pv_window_size-1::self.pv_window_size]
+        if pad_size > 0: #the last window is padded and assigned to the last review
+            window_review_idxs = np.append(window_review_idxs, review_idxs[-1])
+        return word_idxs, window_review_idxs
+
+    def get_seq_lengths(self):
+        #sequence length of each train sample as padded by the dataloader: the query and the user's previous items
+        review_idxs = self.train_review_idxs.astype(np.int64)
+        if self.args.do_seq_review_train:
+            u_counts = self.global_data.review_loc_time[review_idxs, 0].astype(np.int64)
+        else: #the train reviews of the user other than the sample's review
+            user_idxs = self.global_data.review_u_p[review_idxs, 0]
+            u_counts = self.prod_data.u_train_review_seq.lengths[user_idxs] - 1
+        if self.uprev_review_limit > 0:
+            u_counts = np.minimum(u_counts, self.uprev_review_limit)
+        return 1 + u_counts
 
     def __len__(self):
+        if self.prod_data.set_name == "train":
+            return len(self.train_review_idxs)
         return len(self._data)
 
     def __getitem__(self, index):
-        return self._data[index]
+        if isinstance(index, tuple): #(epoch data, index) from the EpochSampler of pipelined epochs
+            epoch_data, index = index
+            if self.epoch_data is None or self.epoch_data.epoch != epoch_data.epoch:
+                epoch_data.install(self)
+        if self.vectorized_collate:
+            return index
+        if self.prod_data.set_name == "train":
+            return self.train_word_idxs[index], self.train_review_idxs[index]
+        query_idx, user_idx, prod_idx, review_idx, candi_start, candi_end = self._data[index].tolist()
+        if self.candi_pool is None:
+            candidate_items = list(range(candi_start, candi_end))
+        else:
+            candidate_items = self.candi_pool[candi_start:candi_end].tolist()
+        return [query_idx, user_idx, prod_idx, review_idx, candidate_items]
@@ -4,17 +4,19 @@ import others.util as util
 import numpy as np
 import random
 from data.batch_data import ProdSearchTrainBatch, ProdSearchTestBatch
+from data.ragged_array import RaggedArray
 
 
 class ProdSearchDataLoader(DataLoader):
     def __init__(self, args, dataset, prepare_pv=True, batch_size=1, shuffle=False, sampler=None,
                  batch_sampler=None, num_workers=0, pin_memory=False,
-                 drop_last=False, timeout=0, worker_init_fn=None):
+                 drop_last=False, timeout=0, worker_init_fn=None, persistent_workers=False):
         super(ProdSearchDataLoader, self).__init__(
             dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
             batch_sampler=batch_sampler, num_workers=num_workers,
             pin_memory=pin_memory, drop_last=drop_last, timeout=timeout,
-            worker_init_fn=worker_init_fn, collate_fn=self._collate_fn)
+            worker_init_fn=worker_init_fn, collate_fn=self._collate_fn,
+            persistent_workers=persistent_workers)
         self.args = args
         self.prepare_pv = prepare_pv
         self.shuffle = shuffle
@@ -28,22 +30,36 @@ class ProdSearchDataLoader(DataLoader):
         self.shuffle_review_words = self.dataset.shuffle_review_words
         self.total_review_limit = self.args.uprev_review_limit + self.args.iprev_review_limit
         if self.args.do_subsample_mask:
-            self.review_words = self.global_data.review_words
             self.sub_sampling_rate = self.prod_data.sub_sampling_rate
         else:
-            self.review_words = self.global_data.padded_review_words
             self.sub_sampling_rate = None
         #if subsampling_rate is 0 then sub_sampling_rate is [1,1,1], all the words are kept
 
+    @property
+    def review_words(self):
+        #padded_review_words is replaced every epoch, also in persistent workers with pipeline_epochs
+        if self.args.do_subsample_mask:
+            return self.global_data.review_words
+        return self.global_data.padded_review_words
+
+    @property
+    def review_word_lengths(self):
+        #number of words in each row of review_words
+        if self.args.do_subsample_mask:
+            return self.global_data.review_word_lengths
+        return self.global_data.padded_review_lengths
+
     def _collate_fn(self, batch):
         if self.prod_data.set_name == 'train':
             return self.get_train_batch(batch)
-        else: #validation or test
+        elif self.args.vectorized_collate: #validation or test
+            return self.get_test_batch_arr(batch)
+        else:
             return self.get_test_batch(batch)
 
     def get_test_batch(self, batch):
         query_idxs = [entry[0] for entry in batch]
-        query_word_idxs = [self.global_data.query_words[x] for x in query_idxs]
+        query_word_idxs = self.global_data.query_words[query_idxs]
         user_idxs = [entry[1] for entry in batch]
         target_prod_idxs = [entry[2] for entry in batch]
         candi_prod_idxs = [entry[4] for entry in batch]
@@ -63,19 +79,23 @@ class ProdSearchDataLoader(DataLoader):
             review_time_stamp = None
             if self.args.do_seq_review_test:
                 review_time_stamp = self.global_data.review_loc_time[review_idx][2]
-            u_item_idxs = [self.global_data.review_u_p[x][1] for x in u_prev_review_idxs]
+            u_item_idxs = self.global_data.review_u_p[u_prev_review_idxs, 1].tolist()
+            candi_locs = [None] * len(candidate_items)
+            if do_seq: #history cut points of all the candidates at once
+                candi_locs = self.global_data.get_item_time_locs(
+                        candidate_items, [review_time_stamp] * len(candidate_items))
 
             candi_batch_item_idxs = []
             candi_batch_user_idxs = []
             candi_batch_seg_idxs = []
             candi_batch_prod_ridxs = []
-            for candi_i in candidate_items:
+            for candi_i, candi_loc in zip(candidate_items, candi_locs):
                 #if self.args.train_review_only:
                 #    candi_i_prev_review_idxs = self.prod_data.p_reviews[candi_i][:self.args.iprev_review_limit]
                 #else:
                 candi_i_prev_review_idxs = self.get_item_review_idxs(
-                        candi_i, None, do_seq, review_time_stamp, fix=True)
-                candi_i_user_idxs = [self.global_data.review_u_p[x][0] for x in candi_i_prev_review_idxs]
+                        candi_i, None, do_seq, review_time_stamp, fix=True, loc_in_i=candi_loc)
+                candi_i_user_idxs = self.global_data.review_u_p[candi_i_prev_review_idxs, 0].tolist()
                 cur_candi_i_user_idxs =  [self.user_pad_idx] + [user_idx] * len(u_prev_review_idxs) + candi_i_user_idxs
                 cur_candi_i_user_idxs = cur_candi_i_user_idxs[:self.total_review_limit+1]
                 cur_candi_i_item_idxs =  [self.prod_pad_idx] + u_item_idxs + [candi_i] * len(candi_i_prev_review_idxs)
@@ -93,21 +113,102 @@ class ProdSearchDataLoader(DataLoader):
             candi_seq_item_idxs.append(candi_batch_item_idxs)
             candi_seq_user_idxs.append(candi_batch_user_idxs)
 
-        candi_prod_idxs = util.pad(candi_prod_idxs, pad_id = -1) #pad reviews
-        candi_prod_ridxs = util.pad_3d(candi_prod_ridxs, pad_id = self.review_pad_idx, dim=1) #pad candi products
-        candi_prod_ridxs = util.pad_3d(candi_prod_ridxs, pad_id = self.review_pad_idx, dim=2) #pad reviews of each candi
-        candi_seg_idxs = util.pad_3d(candi_seg_idxs, pad_id = self.seg_pad_idx, dim=1)
-        candi_seg_idxs = util.pad_3d(candi_seg_idxs, pad_id = self.seg_pad_idx, dim=2)
-        candi_seq_user_idxs = util.pad_3d(candi_seq_user_idxs, pad_id = self.user_pad_idx, dim=1)
-        candi_seq_user_idxs = util.pad_3d(candi_seq_user_idxs, pad_id = self.user_pad_idx, dim=2)
-        candi_seq_item_idxs = util.pad_3d(candi_seq_item_idxs, pad_id = self.prod_pad_idx, dim=1)
-        candi_seq_item_idxs = util.pad_3d(candi_seq_item_idxs, pad_id = self.prod_pad_idx, dim=2)
+        candi_prod_idxs = util.pad_array(candi_prod_idxs, pad_id = -1) #pad reviews
+        candi_prod_ridxs = util.pad_3d_array(candi_prod_ridxs, pad_id = self.review_pad_idx) #pad candi products and their reviews
+        candi_seg_idxs = util.pad_3d_array(candi_seg_idxs, pad_id = self.seg_pad_idx)
+        candi_seq_user_idxs = util.pad_3d_array(candi_seq_user_idxs, pad_id = self.user_pad_idx)
+        candi_seq_item_idxs = util.pad_3d_array(candi_seq_item_idxs, pad_id = self.prod_pad_idx)
 
         batch = ProdSearchTestBatch(query_idxs, user_idxs, target_prod_idxs, candi_prod_idxs,
                 query_word_idxs, candi_prod_ridxs, candi_seg_idxs,
                 candi_seq_user_idxs, candi_seq_item_idxs)
         return batch
 
+    def get_test_batch_arr(self, batch):
+        #same as get_test_batch, with the histories of all the candidates gathered at once
+        query_idxs = [entry[0] for entry in batch]
+        query_word_idxs = self.global_data.query_words[query_idxs]
+        user_idxs = [entry[1] for entry in batch]
+        target_prod_idxs = [entry[2] for entry in batch]
+        review_idxs = np.asarray([entry[3] for entry in batch], dtype=np.int64)
+        candi_matrix = util.pad_array([entry[4] for entry in batch], pad_id = -1)
+        candi_prod_idxs = candi_matrix
+        candi_masks = candi_matrix >= 0
+        do_seq = self.args.do_seq_review_test and not self.args.train_review_only
+        u_review_arr = self.get_user_review_idx_arr(user_idxs, review_idxs, do_seq, fix=True)
+        review_time_stamps = self.global_data.review_loc_time[review_idxs, 2]
+        i_review_arr = self.get_item_review_idx_arr(candi_matrix[candi_masks], None, do_seq,
+                np.repeat(review_time_stamps, candi_masks.sum(axis=1)), fix=True)
+        candi_prod_ridxs, candi_seg_idxs, candi_seq_user_idxs, candi_seq_item_idxs = self.get_seq_arrays(
+                user_idxs, u_review_arr, candi_matrix, candi_masks, i_review_arr)
+
+        batch = ProdSearchTestBatch(query_idxs, user_idxs, target_prod_idxs, candi_prod_idxs,
+                query_word_idxs, candi_prod_ridxs, candi_seg_idxs,
+                candi_seq_user_idxs, candi_seq_item_idxs)
+        return batch
+
+    def get_user_review_idx_arr(self, user_idxs, review_idxs, do_seq, fix=True):
+        #get_user_review_idxs for a batch, as a RaggedArray with one row per entry
+        if do_seq:
+            return self.global_data.u_r_seq.select(user_idxs, ends=self.global_data.review_loc_time[review_idxs, 0],
+                    limit=self.args.uprev_review_limit)
+        return self.prod_data.u_train_review_seq.select(user_idxs, limit=self.args.uprev_review_limit,
+                excludes=review_idxs, randomly=not fix)
+
+    def get_item_review_idx_arr(self, prod_idxs, review_idxs, do_seq, review_time_stamps=None, fix=True):
+        #get_item_review_idxs for a batch; with review_idxs None the histories are cut at review_time_stamps if do_seq
+        if do_seq:
+            if review_idxs is None:
+                locs = self.global_data.get_item_time_locs(prod_idxs, review_time_stamps)
+            else:
+                locs = self.global_data.review_loc_time[review_idxs, 1]
+            return self.global_data.i_r_seq.select(prod_idxs, ends=locs, limit=self.args.iprev_review_limit)
+        return self.prod_data.p_train_review_seq.select(prod_idxs, limit=self.args.iprev_review_limit,
+                excludes=review_idxs, randomly=not fix)
+
+    def get_seq_arrays(self, user_idxs, u_review_arr, candi_matrix, candi_masks, i_review_arr):
+        #review, segment, user and item ids of [query, reviews of the user, reviews of the candidate]
+        #for each candidate in candi_matrix (batch_size, candi_size) where candi_masks is set;
+        #u_review_arr has the reviews of each user and i_review_arr those of the candidates in row-major order
+        u_counts = u_review_arr.lengths
+        i_counts = np.zeros(candi_masks.shape, dtype=np.int64)
+        i_counts[candi_masks] = i_review_arr.lengths
+        #the extra column keeps the gathers below in range
+        u_review_idxs = u_review_arr.to_padded(self.review_pad_idx, width=u_counts.max()+1).astype(np.int64)
+        u_masks = np.arange(u_review_idxs.shape[1])[None,:] < u_counts[:,None]
+        u_item_idxs = np.full(u_review_idxs.shape, self.prod_pad_idx, dtype=np.int64)
+        u_item_idxs[u_masks] = self.global_data.review_u_p[u_review_idxs[u_masks], 1]
+        hist_width = (i_counts.max() if i_counts.size > 0 else 0) + 1
+        i_review_idxs = np.full(candi_masks.shape + (hist_width,), self.review_pad_idx, dtype=np.int64)
+        i_review_idxs[candi_masks] = i_review_arr.to_padded(self.review_pad_idx, width=hist_width)
+        i_user_idxs = np.full(i_review_idxs.shape, self.user_pad_idx, dtype=np.int64)
+        i_user_idxs[candi_masks] = RaggedArray(i_review_arr.offsets,
+                self.global_data.review_u_p[i_review_arr.values, 0]).to_padded(self.user_pad_idx, width=hist_width)
+
+        #position j of a sequence is the j-th user review, then the reviews of the candidate, truncated to total_review_limit
+        seq_lengths = np.where(candi_masks, u_counts[:,None] + i_counts, 0)
+        width = seq_lengths.max() if seq_lengths.size > 0 else 0
+        width = min(width, self.total_review_limit)
+        seq_cols = np.arange(width)[None,None,:]
+        from_u = (seq_cols < u_counts[:,None,None]) & candi_masks[:,:,None]
+        from_i = ~from_u & (seq_cols < seq_lengths[:,:,None])
+        u_cols = np.minimum(seq_cols[0,0], u_review_idxs.shape[1]-1)
+        i_cols = np.broadcast_to(np.clip(seq_cols - u_counts[:,None,None], 0, hist_width-1),
+                candi_masks.shape + (width,))
+        seq_review_idxs = np.where(from_u, u_review_idxs[:,None,u_cols],
+                np.where(from_i, np.take_along_axis(i_review_idxs, i_cols, axis=2), self.review_pad_idx))
+        seq_users = np.where(from_u, np.asarray(user_idxs, dtype=np.int64)[:,None,None],
+                np.where(from_i, np.take_along_axis(i_user_idxs, i_cols, axis=2), self.user_pad_idx))
+        seq_items = np.where(from_u, u_item_idxs[:,None,u_cols],
+                np.where(from_i, candi_matrix[:,:,None], self.prod_pad_idx))
+        seq_segs = np.where(from_u, 1, np.where(from_i, 2, self.seg_pad_idx))
+        #the first position of each sequence is for the query
+        first_col = np.ones(candi_masks.shape + (1,), dtype=np.int64)
+        seq_segs = np.concatenate([np.where(candi_masks[:,:,None], 0, self.seg_pad_idx) * first_col, seq_segs], axis=2)
+        seq_users = np.concatenate([self.user_pad_idx * first_col, seq_users], axis=2)
+        seq_items = np.concatenate([self.prod_pad_idx * first_col, seq_items], axis=2)
+        return seq_review_idxs, seq_segs, seq_users, seq_items
+
     def get_item_review_idxs_prev(self, prod_idx, review_idx, do_seq, review_time_stamp=None,fix=True):
         if do_seq:
             if review_idx is None:
@@ -117,7 +218,7 @@ class ProdSearchDataLoader(DataLoader):
                 loc_in_i = self.global_data.review_loc_time[review_idx][1]
             if loc_in_i == 0:
                 return []
-            i_prev_review_idxs = self.global_data.i_r_seq[prod_idx][:loc_in_i]
+            i_prev_review_idxs = self.global_data.i_r_seq[prod_idx][:loc_in_i].tolist()
             i_prev_review_idxs = i_prev_review_idxs[-self.args.iprev_review_limit:]
             #i_prev_review_idxs = self.global_data.i_r_seq[prod_idx][max(0,loc_in_i-self.args.iprev_review_limit):loc_in_i]
 
@@ -132,36 +233,35 @@ class ProdSearchDataLoader(DataLoader):
 
         return i_prev_review_idxs
 
-    def get_item_review_idxs(self, prod_idx, review_idx, do_seq, review_time_stamp=None,fix=True):
-        i_seq_review_idxs = self.global_data.i_r_seq[prod_idx]
-        i_train_review_set = self.prod_data.p_reviews[prod_idx]
+    def get_item_review_idxs(self, prod_idx, review_idx, do_seq, review_time_stamp=None,fix=True, loc_in_i=None):
         if do_seq:
-            if review_idx is None:
-                loc_in_i = self.dataset.bisect_right(
-                        self.global_data.i_r_seq[prod_idx], self.global_data.review_loc_time, review_time_stamp)
+            if loc_in_i is not None: #already looked up with get_item_time_locs
+                pass
+            elif review_idx is None:
+                loc_in_i = self.global_data.get_item_time_locs([prod_idx], [review_time_stamp])[0]
             else:
                 loc_in_i = self.global_data.review_loc_time[review_idx][1]
             if loc_in_i == 0:
                 return []
-            i_prev_review_idxs = self.global_data.i_r_seq[prod_idx][:loc_in_i]
+            i_prev_review_idxs = self.global_data.i_r_seq[prod_idx][:loc_in_i].tolist()
             i_prev_review_idxs = i_prev_review_idxs[-self.args.iprev_review_limit:]
+        elif fix:
+            i_prev_review_idxs = self.prod_data.get_item_train_review_idxs(
+                    prod_idx, review_idx, limit=self.args.iprev_review_limit)
         else:
-            i_seq_train_review_idxs = [x for x in i_seq_review_idxs if x in i_train_review_set and x!= review_idx]
+            i_seq_train_review_idxs = self.prod_data.get_item_train_review_idxs(prod_idx, review_idx)
             i_prev_review_idxs = i_seq_train_review_idxs
             if len(i_prev_review_idxs) > self.args.iprev_review_limit:
-                if fix:
-                    i_prev_review_idxs = i_prev_review_idxs[-self.args.iprev_review_limit:]
-                else:
-                    rand_review_set = random.sample(i_seq_train_review_idxs, self.args.iprev_review_limit)
-                    rand_review_set = set(rand_review_set)
-                    i_prev_review_idxs = [x for x in i_seq_train_review_idxs if x in rand_review_set]
+                rand_review_set = random.sample(i_seq_train_review_idxs, self.args.iprev_review_limit)
+                rand_review_set = set(rand_review_set)
+                i_prev_review_idxs = [x for x in i_seq_train_review_idxs if x in rand_review_set]
 
         return i_prev_review_idxs
 
     def get_user_review_idxs_prev(self, user_idx, review_idx, do_seq, fix=True):
         if do_seq:
             loc_in_u = self.global_data.review_loc_time[review_idx][0]
-            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u]
+            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u].tolist()
             u_prev_review_idxs = u_prev_review_idxs[-self.args.uprev_review_limit:]
             #u_prev_review_idxs = self.global_data.u_r_seq[user_idx][max(0,loc_in_u-self.uprev_review_limit):loc_in_u]
         else:
@@ -175,29 +275,34 @@ class ProdSearchDataLoader(DataLoader):
         return u_prev_review_idxs
 
     def get_user_review_idxs(self, user_idx, review_idx, do_seq, fix=True):
-        u_seq_review_idxs = self.global_data.u_r_seq[user_idx]
-        u_train_review_set = self.prod_data.u_reviews[user_idx] #set
         if do_seq:
             loc_in_u = self.global_data.review_loc_time[review_idx][0]
-            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u]
+            u_prev_review_idxs = self.global_data.u_r_seq[user_idx][:loc_in_u].tolist()
             u_prev_review_idxs = u_prev_review_idxs[-self.args.uprev_review_limit:]
+        elif fix:
+            u_prev_review_idxs = self.prod_data.get_user_train_review_idxs(
+                    user_idx, review_idx, limit=self.args.uprev_review_limit)
         else:
-            u_seq_train_review_idxs = [x for x in u_seq_review_idxs if x in u_train_review_set and x!= review_idx]
+            u_seq_train_review_idxs = self.prod_data.get_user_train_review_idxs(user_idx, review_idx)
             u_prev_review_idxs = u_seq_train_review_idxs
             if len(u_seq_train_review_idxs) > self.args.uprev_review_limit:
-                if fix:
-                    u_prev_review_idxs = u_seq_train_review_idxs[-self.args.uprev_review_limit:]
-                else:
-                    rand_review_set = random.sample(u_seq_train_review_idxs, self.args.uprev_review_limit)
-                    rand_review_set = set(rand_review_set)
-                    u_prev_review_idxs = [x for x in u_seq_train_review_idxs if x in rand_review_set]
+                rand_review_set = random.sample(u_seq_train_review_idxs, self.args.uprev_review_limit)
+                rand_review_set = set(rand_review_set)
+                u_prev_review_idxs = [x for x in u_seq_train_review_idxs if x in rand_review_set]
         return u_prev_review_idxs
 
     def prepare_train_batch(self, batch):
         batch_query_word_idxs = []
         batch_pos_prod_ridxs, batch_pos_seg_idxs, batch_pos_user_idxs, batch_pos_item_idxs = [],[],[],[]
         batch_neg_prod_ridxs, batch_neg_seg_idxs, batch_neg_user_idxs, batch_neg_item_idxs = [],[],[],[]
-        for line_id, user_idx, prod_idx, review_idx in batch:
+        batch_neg_locs = [[None] * self.args.neg_per_pos] * len(batch)
+        if self.args.do_seq_review_train: #history cut points of all the negative items at once
+            line_ids = [entry[0] for entry in batch]
+            review_idxs = [entry[3] for entry in batch]
+            neg_prod_idxs = self.prod_data.neg_sample_products[line_ids]
+            timestamps = np.repeat(self.global_data.review_loc_time[review_idxs, 2:3], neg_prod_idxs.shape[1], axis=1)
+            batch_neg_locs = self.global_data.get_item_time_locs(neg_prod_idxs, timestamps)
+        for entry_no, (line_id, user_idx, prod_idx, review_idx) in enumerate(batch):
             query_idx = random.choice(self.prod_data.product_query_idx[prod_idx])
             query_word_idxs = self.global_data.query_words[query_idx]
             u_prev_review_idxs = self.get_user_review_idxs(user_idx, review_idx, self.args.do_seq_review_train, fix=False)
@@ -207,8 +312,8 @@ class ProdSearchDataLoader(DataLoader):
                 review_time_stamp = self.global_data.review_loc_time[review_idx][2]
             if len(i_prev_review_idxs) == 0:
                 continue
-            i_user_idxs = [self.global_data.review_u_p[x][0] for x in i_prev_review_idxs]
-            u_item_idxs = [self.global_data.review_u_p[x][1] for x in u_prev_review_idxs]
+            i_user_idxs = self.global_data.review_u_p[i_prev_review_idxs, 0].tolist()
+            u_item_idxs = self.global_data.review_u_p[u_prev_review_idxs, 1].tolist()
             pos_user_idxs =  [self.user_pad_idx] + [user_idx] * len(u_prev_review_idxs) + i_user_idxs
             pos_user_idxs = pos_user_idxs[:self.total_review_limit + 1]
             pos_item_idxs =  [self.prod_pad_idx] + u_item_idxs + [prod_idx] * len(i_prev_review_idxs)
@@ -223,12 +328,12 @@ class ProdSearchDataLoader(DataLoader):
             neg_seg_idxs = []
             neg_user_idxs = []
             neg_item_idxs = []
-            for neg_i in neg_prod_idxs:
+            for neg_i, neg_loc in zip(neg_prod_idxs, batch_neg_locs[entry_no]):
                 neg_i_prev_review_idxs = self.get_item_review_idxs(
-                        neg_i, None, self.args.do_seq_review_train, review_time_stamp, fix=False)
+                        neg_i, None, self.args.do_seq_review_train, review_time_stamp, fix=False, loc_in_i=neg_loc)
                 if len(neg_i_prev_review_idxs) == 0:
                     continue
-                neg_i_user_idxs = [self.global_data.review_u_p[x][0] for x in neg_i_prev_review_idxs]
+                neg_i_user_idxs = self.global_data.review_u_p[neg_i_prev_review_idxs, 0].tolist()
                 cur_neg_i_user_idxs =  [self.user_pad_idx] + [user_idx] * len(u_prev_review_idxs) + neg_i_user_idxs
                 cur_neg_i_user_idxs = cur_neg_i_user_idxs[:self.total_review_limit+1]
                 cur_neg_i_item_idxs =  [self.prod_pad_idx] + u_item_idxs + [neg_i] * len(neg_i_prev_review_idxs)
@@ -259,6 +364,51 @@ class ProdSearchDataLoader(DataLoader):
                 batch_neg_prod_ridxs, batch_neg_seg_idxs, batch_pos_user_idxs,
                 batch_neg_user_idxs, batch_pos_item_idxs, batch_neg_item_idxs]
         return data_batch
+
+    def prepare_train_batch_arr(self, batch):
+        #prepare_train_batch with array operations; the sequences are returned padded
+        line_ids, user_idxs, prod_idxs, review_idxs = np.asarray(batch, dtype=np.int64).reshape(-1, 4).T
+        do_seq = self.args.do_seq_review_train
+        u_review_arr = self.get_user_review_idx_arr(user_idxs, review_idxs, do_seq, fix=False)
+        i_review_arr = self.get_item_review_idx_arr(prod_idxs, review_idxs, do_seq, fix=False)
+        neg_prod_idxs = self.prod_data.neg_sample_products[line_ids].astype(np.int64)
+        neg_per_pos = neg_prod_idxs.shape[1]
+        review_time_stamps = np.repeat(self.global_data.review_loc_time[review_idxs, 2], neg_per_pos)
+        neg_review_arr = self.get_item_review_idx_arr(
+                neg_prod_idxs.reshape(-1), None, do_seq, review_time_stamps, fix=False)
+        #entries without reviews of the positive item or of all the negative items are skipped,
+        #so are the negative items without reviews
+        neg_masks = neg_review_arr.lengths.reshape(-1, neg_per_pos) > 0
+        entry_idxs = np.flatnonzero((i_review_arr.lengths > 0) & neg_masks.any(axis=1))
+        if len(entry_idxs) == 0:
+            return [[]] * 9
+        neg_orders = np.argsort(~neg_masks[entry_idxs], axis=1, kind='stable') #available negatives first
+        neg_masks = np.take_along_axis(neg_masks[entry_idxs], neg_orders, axis=1)
+        neg_count = neg_masks.sum(axis=1).max()
+        neg_masks = neg_masks[:,:neg_count]
+        neg_orders = neg_orders[:,:neg_count]
+        neg_prod_idxs = np.take_along_axis(neg_prod_idxs[entry_idxs], neg_orders, axis=1)
+        neg_review_arr = neg_review_arr.take((entry_idxs[:,None] * neg_per_pos + neg_orders)[neg_masks])
+
+        user_idxs = user_idxs[entry_idxs]
+        prod_idxs = prod_idxs[entry_idxs]
+        u_review_arr = u_review_arr.take(entry_idxs)
+        #one random query of each positive item
+        query_seq = self.prod_data.product_query_seq
+        query_starts = query_seq.offsets[prod_idxs]
+        query_counts = query_seq.offsets[prod_idxs+1] - query_starts
+        query_idxs = query_seq.values[query_starts + (np.random.random(len(prod_idxs)) * query_counts).astype(np.int64)]
+        query_word_idxs = self.global_data.query_words[query_idxs]
+
+        pos_prod_ridxs, pos_seg_idxs, pos_user_idxs, pos_item_idxs = self.get_seq_arrays(
+                user_idxs, u_review_arr, prod_idxs[:,None], np.ones((len(prod_idxs), 1), dtype=bool),
+                i_review_arr.take(entry_idxs))
+        neg_prod_ridxs, neg_seg_idxs, neg_user_idxs, neg_item_idxs = self.get_seq_arrays(
+                user_idxs, u_review_arr, neg_prod_idxs, neg_masks, neg_review_arr)
+        data_batch = [query_word_idxs, pos_prod_ridxs[:,0], pos_seg_idxs[:,0],
+                neg_prod_ridxs, neg_seg_idxs, pos_user_idxs[:,0],
+                neg_user_idxs, pos_item_idxs[:,0], neg_item_idxs]
+        return data_batch
     '''
     u, Q, i (positive, negative)
     Q; ru1,ru2,ri1,ri2 and k negative (ru1,ru2,rn1i1,rn1i2; ru1,ru2,rnji1,rnji2)
@@ -272,37 +422,42 @@ class ProdSearchDataLoader(DataLoader):
     batch_size, neg_k, review_count (u+i), max_word_count_per_review
     '''
     def get_train_batch(self, batch):
-        query_word_idxs, pos_prod_ridxs, pos_seg_idxs, \
-                neg_prod_ridxs, neg_seg_idxs, pos_user_idxs, \
-                neg_user_idxs, pos_item_idxs, neg_item_idxs = self.prepare_train_batch(batch)
+        if self.args.vectorized_collate:
+            query_word_idxs, pos_prod_ridxs, pos_seg_idxs, \
+                    neg_prod_ridxs, neg_seg_idxs, pos_user_idxs, \
+                    neg_user_idxs, pos_item_idxs, neg_item_idxs = self.prepare_train_batch_arr(batch)
+        else:
+            query_word_idxs, pos_prod_ridxs, pos_seg_idxs, \
+                    neg_prod_ridxs, neg_seg_idxs, pos_user_idxs, \
+                    neg_user_idxs, pos_item_idxs, neg_item_idxs = self.prepare_train_batch(batch)
         if len(query_word_idxs) == 0:
             print("0 available instance in the batch")
             return None
-        pos_prod_ridxs = util.pad(pos_prod_ridxs, pad_id = self.review_pad_idx) #pad reviews
-        pos_seg_idxs = util.pad(pos_seg_idxs, pad_id = self.seg_pad_idx)
-        pos_user_idxs = util.pad(pos_user_idxs, pad_id = self.user_pad_idx)
-        pos_item_idxs = util.pad(pos_item_idxs, pad_id = self.prod_pad_idx)
-        pos_prod_ridxs = np.asarray(pos_prod_ridxs)
+        if not self.args.vectorized_collate:
+            pos_prod_ridxs = util.pad_array(pos_prod_ridxs, pad_id = self.review_pad_idx) #pad reviews
+            pos_seg_idxs = util.pad_array(pos_seg_idxs, pad_id = self.seg_pad_idx)
+            pos_user_idxs = util.pad_array(pos_user_idxs, pad_id = self.user_pad_idx)
+            pos_item_idxs = util.pad_array(pos_item_idxs, pad_id = self.prod_pad_idx)
+            neg_prod_ridxs = util.pad_3d_array(neg_prod_ridxs, pad_id = self.review_pad_idx) #pad neg products and their reviews
+            neg_seg_idxs = util.pad_3d_array(neg_seg_idxs, pad_id = self.seg_pad_idx)
+            neg_user_idxs = util.pad_3d_array(neg_user_idxs, pad_id = self.user_pad_idx)
+            neg_item_idxs = util.pad_3d_array(neg_item_idxs, pad_id = self.prod_pad_idx)
+        query_word_idxs, pos_prod_ridxs, pos_seg_idxs, pos_user_idxs, pos_item_idxs, \
+                neg_prod_ridxs, neg_seg_idxs, neg_user_idxs, neg_item_idxs = map(np.asarray, [
+                    query_word_idxs, pos_prod_ridxs, pos_seg_idxs, pos_user_idxs, pos_item_idxs,
+                    neg_prod_ridxs, neg_seg_idxs, neg_user_idxs, neg_item_idxs])
         batch_size, pos_rcount = pos_prod_ridxs.shape
-        pos_prod_rword_idxs = [self.review_words[x] for x in pos_prod_ridxs.reshape(-1)]
-        #pos_prod_rword_idxs = util.pad(pos_prod_rword_idxs, pad_id = self.word_pad_idx)
-        pos_prod_rword_idxs = np.asarray(pos_prod_rword_idxs).reshape(batch_size, pos_rcount, -1)
+        #rows of the padded review word matrix
+        word_limit = self.review_words.shape[1]
+        if self.args.trim_review_words: #only up to the longest review in the batch
+            review_word_lengths = self.review_word_lengths
+            word_limit = max(1, review_word_lengths[pos_prod_ridxs].max(),
+                    review_word_lengths[neg_prod_ridxs].max() if neg_prod_ridxs.size > 0 else 0)
+        pos_prod_rword_idxs = self.review_words[pos_prod_ridxs, :word_limit]
         pos_prod_rword_masks = self.dataset.get_pv_word_masks(
                 #pos_prod_rword_idxs, self.prod_data.sub_sampling_rate, pad_id=self.word_pad_idx)
                 pos_prod_rword_idxs, self.sub_sampling_rate, pad_id=self.word_pad_idx)
-        neg_prod_ridxs = util.pad_3d(neg_prod_ridxs, pad_id = self.review_pad_idx, dim=1) #pad neg products
-        neg_prod_ridxs = util.pad_3d(neg_prod_ridxs, pad_id = self.review_pad_idx, dim=2) #pad reviews of each neg
-        neg_seg_idxs = util.pad_3d(neg_seg_idxs, pad_id = self.seg_pad_idx, dim=1)
-        neg_seg_idxs = util.pad_3d(neg_seg_idxs, pad_id = self.seg_pad_idx, dim=2)
-        neg_user_idxs = util.pad_3d(neg_user_idxs, pad_id = self.user_pad_idx, dim=1)
-        neg_user_idxs = util.pad_3d(neg_user_idxs, pad_id = self.user_pad_idx, dim=2)
-        neg_item_idxs = util.pad_3d(neg_item_idxs, pad_id = self.prod_pad_idx, dim=1)
-        neg_item_idxs = util.pad_3d(neg_item_idxs, pad_id = self.prod_pad_idx, dim=2)
-        neg_prod_ridxs = np.asarray(neg_prod_ridxs)
-        _, neg_k, nr_count = neg_prod_ridxs.shape
-        neg_prod_rword_idxs = [self.review_words[x] for x in neg_prod_ridxs.reshape(-1)]
-        #neg_prod_rword_idxs = util.pad(neg_prod_rword_idxs, pad_id = self.word_pad_idx)
-        neg_prod_rword_idxs = np.asarray(neg_prod_rword_idxs).reshape(batch_size, neg_k, nr_count, -1)
+        neg_prod_rword_idxs = self.review_words[neg_prod_ridxs, :word_limit]
 
         if "pv" in self.dataset.review_encoder_name and self.prepare_pv:
             pos_prod_rword_idxs_pvc = pos_prod_rword_idxs
@@ -333,8 +488,6 @@ class ProdSearchDataLoader(DataLoader):
                 slide_pos_prod_rword_masks = slide_pos_prod_rword_masks[I]
             slide_pos_prod_rword_idxs = slide_pos_prod_rword_idxs.reshape(seg_count, batch_size, pos_rcount, -1)
             slide_pos_prod_rword_masks = slide_pos_prod_rword_masks.reshape(seg_count, batch_size, pos_rcount, -1)
-            query_word_idxs, pos_prod_ridxs, pos_seg_idxs, neg_prod_ridxs, neg_seg_idxs \
-                    = map(np.asarray, [query_word_idxs, pos_prod_ridxs, pos_seg_idxs, neg_prod_ridxs, neg_seg_idxs])
             batch = [ProdSearchTrainBatch(query_word_idxs[batch_indices[i]],
                 pos_prod_ridxs[batch_indices[i]], pos_seg_idxs[batch_indices[i]],
                 slide_pos_prod_rword_idxs[i], slide_pos_prod_rword_masks[i],
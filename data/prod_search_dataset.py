@@ -35,15 +35,23 @@ class ProdSearchDataset(Dataset):
         self.total_review_limit = self.uprev_review_limit + self.iprev_review_limit
         self.global_data = global_data
         self.prod_data = prod_data
+        self.epoch_data = None #set with pipeline_epochs
+        self.catalog_topk = False #reviews of each candidate are encoded, so candidates are always segmented
         if prod_data.set_name == "train":
             self._data = self.collect_train_samples(self.global_data, self.prod_data)
         else:
-            self._data = self.collect_test_samples(self.global_data, self.prod_data, args.candi_batch_size)
+            self._data, self.candi_pool = self.collect_test_samples(self.global_data, self.prod_data, args.candi_batch_size)
+            self._data = global_data.share_array(self._data)
+            self.candi_pool = global_data.share_array(self.candi_pool)
 
     def collect_test_samples(self, global_data, prod_data, candi_batch_size=1000):
         #Q, review of u + review of pos i, review of u + review of neg i;
         #words of pos reviews; words of neg reviews, all if encoder is not pv
-        test_data = []
+        #each row is (query_idx, user_idx, prod_idx, review_idx, candi_start, candi_end); the candidates are
+        #products candi_start to candi_end-1, or candi_pool[candi_start:candi_end] when candidates are
+        #sampled or read from a ranklist, and are only materialized in __getitem__
+        pairs = []
+        uq_candidates = []
         uq_set = set()
         for line_id, user_idx, prod_idx, review_idx in prod_data.review_info:
             if (line_id+1) % 10000 == 0:
@@ -56,31 +64,37 @@ class ProdSearchDataset(Dataset):
                 if (user_idx, query_idx) in uq_set:
                     continue
                 uq_set.add((user_idx, query_idx))
-
-                #candidate item list according to user_idx and query_idx, or by default all the items
-                #candidate_items = list(range(global_data.product_size))[:1000]
-                if prod_data.uq_pids is None:
-                    if self.prod_data.set_name == "valid" and self.valid_candi_size > 1:
-                        candidate_items = np.random.choice(global_data.product_size,
-                                size=self.valid_candi_size-1, replace=False, p=prod_data.product_dists).tolist()
-                        #candidate_items = np.random.randint(0, global_data.product_size, size =self.valid_candi_size-1).tolist()
-                        candidate_items.append(prod_idx)
-                        random.shuffle(candidate_items)
-                    else:
-                        candidate_items = list(range(global_data.product_size))
-                else:
-                    #print(global_data.user_ids[user_idx], query_idx)
-                    candidate_items = prod_data.uq_pids[(global_data.user_ids[user_idx], query_idx)]
+                pairs.append([query_idx, user_idx, prod_idx, review_idx])
+                if prod_data.uq_pids is not None:
+                    #candidate item list according to user_idx and query_idx
+                    candidate_items = list(prod_data.uq_pids[(global_data.user_ids[user_idx], query_idx)])
                     random.shuffle(candidate_items)
-                    #candidate_items = [global_data.product_asin2ids[x] for x in asin_list]
-                    #print(len(candidate_items))
-                seg_count = int((len(candidate_items) - 1) / candi_batch_size) + 1
-                for i in range(seg_count):
-                    test_data.append([query_idx, user_idx, prod_idx, review_idx,
-                        candidate_items[i*candi_batch_size:(i+1)*candi_batch_size]])
+                    uq_candidates.append(np.asarray(candidate_items, dtype=np.int32))
         print(len(uq_set))
-
-        return test_data
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 4)
+
+        candi_pool = None
+        if prod_data.uq_pids is None and self.prod_data.set_name == "valid" and self.valid_candi_size > 1:
+            #all the candidate sets are sampled at once
+            candi_pool = prod_data.sample_valid_candidates(pairs[:,2], self.valid_candi_size).reshape(-1)
+            candi_counts = np.full(len(pairs), self.valid_candi_size, dtype=np.int64)
+        elif prod_data.uq_pids is None: #by default all the items
+            candi_counts = np.full(len(pairs), global_data.product_size, dtype=np.int64)
+        else:
+            candi_pool = np.concatenate(uq_candidates) if len(uq_candidates) > 0 else np.zeros(0, dtype=np.int32)
+            candi_counts = np.asarray([len(x) for x in uq_candidates], dtype=np.int64)
+        candi_starts = np.zeros(len(pairs), dtype=np.int64)
+        if candi_pool is not None:
+            candi_starts = np.cumsum(candi_counts) - candi_counts
+
+        #cut the candidates of each pair into segments of candi_batch_size, at least one segment per pair
+        seg_counts = np.maximum(candi_counts - 1, 0) // candi_batch_size + 1
+        seg_pair_idxs = np.repeat(np.arange(len(pairs)), seg_counts)
+        seg_nos = np.arange(len(seg_pair_idxs)) - np.repeat(np.cumsum(seg_counts) - seg_counts, seg_counts)
+        seg_starts = candi_starts[seg_pair_idxs] + seg_nos * candi_batch_size
+        seg_ends = np.minimum(seg_starts + candi_batch_size, (candi_starts + candi_counts)[seg_pair_idxs])
+        test_data = np.column_stack([pairs[seg_pair_idxs], seg_starts, seg_ends])
+        return test_data, candi_pool
 
 
     def collect_train_samples(self, global_data, prod_data):
@@ -88,6 +102,22 @@ class ProdSearchDataset(Dataset):
         #words of pos reviews; words of neg reviews, all if encoder is not pv
         return prod_data.review_info
 
+    def get_seq_lengths(self):
+        #sequence length of each train sample as padded by the dataloader:
+        #the query, the previous reviews of the user and those of the item
+        _, user_idxs, prod_idxs, review_idxs = np.asarray(self._data, dtype=np.int64).reshape(-1, 4).T
+        if self.args.do_seq_review_train:
+            u_counts = self.global_data.review_loc_time[review_idxs, 0].astype(np.int64)
+            i_counts = self.global_data.review_loc_time[review_idxs, 1].astype(np.int64)
+        else: #the train reviews of the user/item other than the sample's review
+            u_counts = self.prod_data.u_train_review_seq.lengths[user_idxs] - 1
+            i_counts = self.prod_data.p_train_review_seq.lengths[prod_idxs] - 1
+        if self.uprev_review_limit > 0:
+            u_counts = np.minimum(u_counts, self.uprev_review_limit)
+        if self.iprev_review_limit > 0:
+            i_counts = np.minimum(i_counts, self.iprev_review_limit)
+        return 1 + u_counts + i_counts
+
     def get_pv_word_masks(self, prod_rword_idxs, subsampling_rate, pad_id):
         if subsampling_rate is not None:
             rand_numbers = np.random.random(prod_rword_idxs.shape)
@@ -101,8 +131,9 @@ class ProdSearchDataset(Dataset):
 
     def shuffle_words_in_reviews(self, prod_rword_idxs):
         #consider random shuffle words
-        for row in prod_rword_idxs:
-            np.random.shuffle(row)
+        #in place, an independent permutation along axis 1 for each index of axis 0 (np.random.shuffle of each row)
+        orders = np.argsort(np.random.random(prod_rword_idxs.shape[:2]), axis=1)
+        prod_rword_idxs[...] = prod_rword_idxs[np.arange(prod_rword_idxs.shape[0])[:,None], orders]
 
     def slide_matrices_for_pv(self, prod_rword_idxs, pv_window_size):
         #review_count * review_word_limit
@@ -130,7 +161,8 @@ class ProdSearchDataset(Dataset):
             prod_rword_idxs = np.pad(prod_rword_idxs, ((0,0),(0,pad_size)),mode='constant', constant_values=pad_id)
 
         seg_count = int(prod_rword_idxs.shape[1]/pv_window_size)
-        return np.asarray([prod_rword_idxs[:,i*pv_window_size:(i+1)*pv_window_size] for i in range(seg_count)])
+        #seg_count, row_count, pv_window_size
+        return prod_rword_idxs.reshape(prod_rword_idxs.shape[0], seg_count, pv_window_size).transpose(1, 0, 2)
 
     def bisect_right(self, review_arr, review_loc_time_arr, timestamp, lo=0, hi=None):
         """Return the index where timestamp is larger than the review in review_arr (sorted)
@@ -155,4 +187,15 @@ class ProdSearchDataset(Dataset):
         return len(self._data)
 
     def __getitem__(self, index):
-        return self._data[index]
+        if isinstance(index, tuple): #(epoch data, index) from the EpochSampler of pipelined epochs
+            epoch_data, index = index
+            if self.epoch_data is None or self.epoch_data.epoch != epoch_data.epoch:
+                epoch_data.install(self)
+        if self.prod_data.set_name == "train":
+            return self._data[index]
+        query_idx, user_idx, prod_idx, review_idx, candi_start, candi_end = self._data[index].tolist()
+        if self.candi_pool is None:
+            candidate_items = list(range(candi_start, candi_end))
+        else:
+            candidate_items = self.candi_pool[candi_start:candi_end].tolist()
+        return [query_idx, user_idx, prod_idx, review_idx, candidate_items]
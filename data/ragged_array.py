@@ -0,0 +1,114 @@
+import numpy as np
+import others.util as util
+
+""" compact CSR storage for a list of int lists
+row i is values[offsets[i]:offsets[i+1]]; values are int32 (int64 if they do not fit), offsets int64
+rows are returned as numpy views, use tolist() where python list semantics (e.g. +) are needed
+"""
+
+class RaggedArray(object):
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    @classmethod
+    def from_lists(cls, line_arr):
+        lengths = np.asarray([len(x) for x in line_arr], dtype=np.int64)
+        offsets = np.zeros(len(line_arr) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((x for line in line_arr for x in line), dtype=np.int64, count=offsets[-1])
+        if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+            values = values.astype(np.int32)
+        return cls(offsets, values)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.take(np.arange(len(self))[idx])
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("row index out of range")
+        return self.values[self.offsets[idx]:self.offsets[idx+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.values[self.offsets[i]:self.offsets[i+1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def tolist(self):
+        values = self.values.tolist()
+        offsets = self.offsets.tolist()
+        return [values[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+    def gather_ranges(self, rows):
+        """ flat positions in values of the given rows, and the row lengths """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows+1] - starts
+        row_starts = np.cumsum(lengths) - lengths #start of each row in the output
+        positions = np.arange(lengths.sum()) - np.repeat(row_starts - starts, lengths)
+        return positions, lengths
+
+    def take(self, rows):
+        positions, lengths = self.gather_ranges(rows)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return RaggedArray(offsets, self.values[positions])
+
+    def select(self, rows, ends=None, limit=-1, excludes=None, randomly=False):
+        """ for each of the rows, the values in row[:end] other than its exclude value, at most limit of them:
+        the last ones, or a random subset if randomly; the values keep their order in the row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        if ends is None:
+            lengths = self.offsets[rows+1] - starts
+        else:
+            lengths = np.asarray(ends, dtype=np.int64)
+        row_starts = np.cumsum(lengths) - lengths
+        row_idxs = np.repeat(np.arange(len(rows)), lengths)
+        col_idxs = np.arange(len(row_idxs)) - row_starts[row_idxs]
+        values = self.values[starts[row_idxs] + col_idxs]
+        keep_masks = np.ones(len(values), dtype=bool)
+        if excludes is not None:
+            keep_masks = values != np.asarray(excludes)[row_idxs]
+        if limit > 0:
+            #rank the values of each row by key and keep the limit smallest
+            keys = np.random.random(len(values)) if randomly else -col_idxs.astype(float)
+            keys[~keep_masks] = np.inf
+            orders = np.lexsort((keys, row_idxs))
+            ranks = np.empty(len(orders), dtype=np.int64)
+            ranks[orders] = np.arange(len(orders)) - row_starts[row_idxs[orders]]
+            keep_masks &= ranks < limit
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_idxs[keep_masks], minlength=len(rows)), out=offsets[1:])
+        return RaggedArray(offsets, values[keep_masks])
+
+    def filter(self, mask):
+        """ keep the values where mask (aligned with values) is True """
+        mask = np.asarray(mask, dtype=bool)
+        kept = np.concatenate([[0], np.cumsum(mask)])
+        return RaggedArray(kept[self.offsets], self.values[mask])
+
+    def append(self, row):
+        offsets = np.append(self.offsets, self.offsets[-1] + len(row))
+        values = np.concatenate([self.values, np.asarray(row, dtype=self.values.dtype)])
+        return RaggedArray(offsets, values)
+
+    def to_padded(self, pad_id, width=-1, rows=None):
+        """ (len(rows), width) matrix of the rows, cut or padded with pad_id to width """
+        ragged_arr = self if rows is None else self.take(rows)
+        return util.pad_csr(ragged_arr.offsets, ragged_arr.values, pad_id, width=width)
+
+    def to_matrix(self):
+        """ dense (len, row_length) matrix when all the rows have the same length """
+        lengths = self.lengths
+        assert len(lengths) == 0 or (lengths == lengths[0]).all()
+        row_length = lengths[0] if len(lengths) > 0 else 0
+        return np.asarray(self.values[self.offsets[0]:self.offsets[-1]]).reshape(len(self), row_length)
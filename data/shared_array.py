@@ -0,0 +1,62 @@
+import numpy as np
+import atexit
+import os
+import shutil
+import tempfile
+import weakref
+
+""" read-only numpy arrays in shared memory for the dataloader workers
+each array is saved once as a .npy file under /dev/shm (the system temp directory if there is none)
+and memory-mapped; forked workers read the same pages instead of private copies, and a SharedArray
+is pickled as its file name, so spawned workers attach to the file as well
+the files are removed when the arrays are garbage collected and at exit, only by the process that created them
+"""
+
+class SharedArray(np.ndarray):
+    def __array_finalize__(self, obj):
+        self.shared_path = None #slices and views are pickled as plain arrays
+
+    def __reduce__(self):
+        if self.shared_path is None:
+            return np.asarray(self).__reduce__()
+        return (attach, (self.shared_path,))
+
+def attach(path):
+    arr = np.load(path, mmap_mode='r').view(SharedArray)
+    arr.shared_path = path
+    return arr
+
+class SharedArrayStore(object):
+    def __init__(self, shm_dir=''):
+        if shm_dir == '':
+            shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.dir = tempfile.mkdtemp(prefix="prodsearch_shm_", dir=shm_dir)
+        self.pid = os.getpid()
+        self.array_count = 0
+        atexit.register(self.close)
+
+    def share(self, arr):
+        """ read-only shared copy of arr """
+        if arr is None or isinstance(arr, SharedArray):
+            return arr
+        #the pid keeps the names of files written by other processes (e.g. forked from this one) apart
+        path = os.path.join(self.dir, "{}_{}.npy".format(os.getpid(), self.array_count))
+        self.array_count += 1
+        np.save(path, np.ascontiguousarray(arr))
+        return self.adopt(path)
+
+    def adopt(self, path):
+        """ attach to a file of the store and remove it when the array is garbage collected,
+        also for files written by another process
+        """
+        shared_arr = attach(path)
+        weakref.finalize(shared_arr, self.remove, path)
+        return shared_arr
+
+    def remove(self, path):
+        if os.getpid() == self.pid and os.path.exists(path): #not in forked workers
+            os.remove(path)
+
+    def close(self):
+        if os.getpid() == self.pid:
+            shutil.rmtree(self.dir, ignore_errors=True)
@@ -82,6 +82,12 @@ def parse_args():
     parser.add_argument("--num_workers", type=int, default=4,
                             help="Number of processes to load batches of data during training.")
     parser.add_argument("--data_dir", type=str, default="/tmp", help="Data directory")
+    parser.add_argument("--use_data_cache", type=str2bool, nargs='?',const=True,default=True,
+            help="convert the gzip data files once into numpy arrays and load those in later runs; the cache is rebuilt when a source file changes.")
+    parser.add_argument("--data_cache_dir", type=str, default="", help="Directory of the data cache; by default it is stored next to each data file")
+    parser.add_argument("--share_memory", type=str2bool, nargs='?',const=True,default=False,
+            help="keep the arrays read by the dataloader workers in read-only shared memory, so that each worker does not end up with its own copy of the data.")
+    parser.add_argument("--share_memory_dir", type=str, default="", help="Directory of the shared memory files; by default /dev/shm")
     parser.add_argument("--input_train_dir", type=str, default="", help="The directory of training and testing data")
     parser.add_argument("--save_dir", type=str, default="/tmp", help="Model directory & output directory")
     parser.add_argument("--log_file", type=str, default="train.log", help="log file name")
@@ -98,9 +98,29 @@ def parse_args():
                             help="When it is 0 or less, all the products are used. Otherwise, test_candi_size samples from ranklist will be reranked")
     parser.add_argument("--candi_batch_size", type=int, default=500,
                             help="Batch size for validation to use during training.")
+    parser.add_argument("--encode_once", type=str2bool, nargs='?',const=True,default=True,
+            help="at test time, encode each (user, query) sequence once and score all its candidates with one matrix multiply; used by the dot-product TEM and by QEM, AEM and ZAM.")
+    parser.add_argument("--full_catalog_topk", type=str2bool, nargs='?',const=True,default=True,
+            help="when all the products are candidates, score the whole catalog in blocks and keep only the top ranked products instead of splitting it into candi_batch_size segments; only for the dot-product TEM and QEM, AEM and ZAM.")
+    parser.add_argument("--catalog_block_size", type=int, default=50000,
+                            help="Number of products scored at a time with full_catalog_topk.")
+    parser.add_argument("--vectorized_collate", type=str2bool, nargs='?',const=True,default=True,
+            help="build batches with array operations instead of per-sample python work: the TEM/QEM/AEM/ZAM dataloader collates a batch from the indices of its samples, and the RTM dataloader gathers the histories of all the test candidates at once.")
+    parser.add_argument("--trim_review_words", type=str2bool, nargs='?',const=True,default=False,
+            help="RTM: cut the word dimension of the reviews in each train batch, and in each slice of reviews encoded for testing, to the longest review in it instead of review_word_limit.")
+    parser.add_argument("--token_budget", type=int, default=0,
+            help="if > 0, train batches are formed from samples with the same user (and item) history length, with at most token_budget sequence positions per batch instead of batch_size samples.")
     parser.add_argument("--num_workers", type=int, default=4,
                             help="Number of processes to load batches of data during training.")
     parser.add_argument("--data_dir", type=str, default="/tmp", help="Data directory")
+    parser.add_argument("--use_data_cache", type=str2bool, nargs='?',const=True,default=True,
+            help="convert the gzip data files once into numpy arrays and load those in later runs; the cache is rebuilt when a source file changes.")
+    parser.add_argument("--data_cache_dir", type=str, default="", help="Directory of the data cache; by default it is stored next to each data file")
+    parser.add_argument("--share_memory", type=str2bool, nargs='?',const=True,default=False,
+            help="keep the arrays read by the dataloader workers in read-only shared memory, so that each worker does not end up with its own copy of the data.")
+    parser.add_argument("--share_memory_dir", type=str, default="", help="Directory of the shared memory files; by default /dev/shm")
+    parser.add_argument("--pipeline_epochs", type=str2bool, nargs='?',const=True,default=False,
+            help="build the train data of the next epoch in a background process while the current epoch trains and keep the dataloader workers across epochs; each epoch is seeded with (seed, epoch). Implies share_memory.")
     parser.add_argument("--input_train_dir", type=str, default="", help="The directory of training and testing data")
     parser.add_argument("--save_dir", type=str, default="/tmp", help="Model directory & output directory")
     parser.add_argument("--log_file", type=str, default="train.log", help="log file name")
@@ -142,6 +162,14 @@ def parse_args():
                             help="How many training steps to do per checkpoint.")
     parser.add_argument("--neg_per_pos", type=int, default=5,
                             help="How many negative samples used to pair with postive results.")
+    parser.add_argument("--neg_sampler", type=str, default="multinomial", choices=["multinomial", "alias"],
+            help="how negative words and products are drawn: torch.multinomial over the distribution on each step, or alias tables built once with O(1) work per sample.")
+    parser.add_argument("--neg_sharing", type=str, default="none", choices=["none", "row", "batch"],
+            help="dot-product TEM training: none re-encodes the [query, history] sequence for each negative as before; row encodes it once and scores the neg_per_pos negatives of each row (the same loss as none without dropout); batch encodes it once and scores a pool of negatives shared by the batch with one matrix multiply. The negatives of each row (with in_batch_neg too) are weighted neg_per_pos / their count, so that they weigh neg_per_pos in total as with none, and pos_weight is unchanged.")
+    parser.add_argument("--neg_pool_size", type=int, default=0,
+                            help="Number of shared negatives with neg_sharing batch; by default batch_size * neg_per_pos.")
+    parser.add_argument("--in_batch_neg", type=str2bool, nargs='?',const=True,default=False,
+            help="with neg_sharing row or batch, also use the positive items of the other rows in the batch as negatives.")
     parser.add_argument("--sparse_emb", action='store_true',
                             help="use sparse embedding or not.")
     parser.add_argument("--scale_grad", action='store_true',
@@ -151,6 +179,8 @@ def parse_args():
     parser.add_argument("--mode", type=str, default="train", choices=["train", "valid", "test"])
     parser.add_argument("--rank_cutoff", type=int, default=100,
                             help="Rank cutoff for output ranklists.")
+    parser.add_argument("--eval_cutoffs", type=int, nargs='+', default=[10, 20, 100],
+                            help="Cutoffs k for which NDCG@k and Recall@k are reported during validation and test.")
     parser.add_argument('--device', default='cuda', choices=['cpu', 'cuda'], help="use CUDA or cpu")
     return parser.parse_args()
 
@@ -194,6 +224,8 @@ def train(args):
     if args.device == "cuda":
         torch.cuda.manual_seed(args.seed)
 
+    if args.pipeline_epochs:
+        args.share_memory = True #the epochs are handed over as shared memory files
     global_data = GlobalProdSearchData(args, args.data_dir, args.input_train_dir)
     train_prod_data = ProdSearchData(args, args.input_train_dir, "train", global_data)
     #subsampling has been done in train_prod_data
@@ -13,13 +13,13 @@ from others.util import load_pretrain_embeddings
 import argparse
 
 class ParagraphVector(nn.Module):
-    def __init__(self, word_embeddings, word_dists, review_count,
+    def __init__(self, word_embeddings, word_sampler, review_count,
             dropout=0.0, pretrain_emb_path=None, fix_emb=False):
         super(ParagraphVector, self).__init__()
         self.word_embeddings = word_embeddings
         self.fix_emb = fix_emb
         self.dropout_ = dropout
-        self.word_dists = word_dists
+        self.word_sampler = word_sampler #models.sampler over the word distribution
         self._embedding_size = self.word_embeddings.weight.size()[-1]
         self.review_count = review_count
         self.review_pad_idx = review_count-1
@@ -54,7 +54,7 @@ class ParagraphVector(nn.Module):
         review_emb = self.drop_layer(review_emb)
         #vocab_size = self.word_embeddings.weight.size() - 1
         #compute the loss of review generating positive and negative words
-        neg_sample_idxs = torch.multinomial(self.word_dists, batch_size * pv_window_size * n_negs, replacement=True)
+        neg_sample_idxs = self.word_sampler.sample(batch_size * pv_window_size * n_negs)
         neg_sample_emb = self.word_embeddings(neg_sample_idxs.view(batch_size,-1))
         output_pos = torch.bmm(review_word_emb, review_emb.unsqueeze(2)) # batch_size, pv_window_size, 1
         output_neg = torch.bmm(neg_sample_emb, review_emb.unsqueeze(2)).view(batch_size, pv_window_size, -1)
@@ -13,11 +13,11 @@ from others.util import load_pretrain_embeddings
 import argparse
 
 class ParagraphVectorCorruption(nn.Module):
-    def __init__(self, word_embeddings, word_dists, corrupt_rate,
+    def __init__(self, word_embeddings, word_sampler, corrupt_rate,
             dropout=0.0, pretrain_emb_path=None, vocab_words=None, fix_emb=False):
         super(ParagraphVectorCorruption, self).__init__()
         self.word_embeddings = word_embeddings
-        self.word_dists = word_dists
+        self.word_sampler = word_sampler #models.sampler over the word distribution
         self._embedding_size = self.word_embeddings.weight.size()[-1]
         vocab_size = self.word_embeddings.weight.size()[0]
         self.word_pad_idx = vocab_size - 1
@@ -80,7 +80,7 @@ class ParagraphVectorCorruption(nn.Module):
 
         #for each target word, there is k words negative sampling
         #compute the loss of review generating positive and negative words
-        neg_sample_idxs = torch.multinomial(self.word_dists, batch_size * pv_window_size * n_negs, replacement=True)
+        neg_sample_idxs = self.word_sampler.sample(batch_size * pv_window_size * n_negs)
         neg_sample_emb = self.word_embeddings(neg_sample_idxs.view(batch_size, -1))
         output_pos = torch.bmm(review_word_emb, corr_review_emb.unsqueeze(2)) # batch_size, pv_window_size, 1
         output_neg = torch.bmm(neg_sample_emb, corr_review_emb.unsqueeze(2)).view(batch_size, pv_window_size, -1)
@@ -110,7 +110,7 @@ class ParagraphVectorCorruption(nn.Module):
         #for each target word, there is k words negative sampling
         vocab_size = word_embeddings.weight.size() - 1
         #compute the loss of review generating positive and negative words
-        neg_sample_idxs = torch.multinomial(self.word_dists, batch_size * pv_window_size * n_negs, replacement=True)
+        neg_sample_idxs = self.word_sampler.sample(batch_size * pv_window_size * n_negs)
         neg_sample_emb = self.word_embeddings(neg_sample_idxs)
         #cuda.longtensor
         #negative sampling according to x^0.75
@@ -10,13 +10,14 @@ import os
 import torch
 import torch.nn as nn
 from models.PV import ParagraphVector
+from models.sampler import build_sampler
 from models.PVC import ParagraphVectorCorruption
 from models.text_encoder import AVGEncoder, FSEncoder, get_vector_mean
 from models.transformer import TransformerEncoder
 from models.neural import MultiHeadedAttention
 from models.optimizers import Optimizer
 from others.logging import logger
-from others.util import pad, load_pretrain_embeddings, load_user_item_embeddings
+from others.util import load_pretrain_embeddings, load_user_item_embeddings
 
 
 class ItemTransformerRanker(nn.Module):
@@ -41,6 +42,9 @@ class ItemTransformerRanker(nn.Module):
 
         self.prod_dists = torch.ones(product_size, device=device)
 
+        self.word_sampler = build_sampler(args.neg_sampler, self.word_dists)
+        self.prod_sampler = build_sampler(args.neg_sampler, self.prod_dists)
+
         self.prod_pad_idx = product_size
         self.word_pad_idx = vocab_size - 1
         self.seg_pad_idx = 3
@@ -145,7 +149,99 @@ class ItemTransformerRanker(nn.Module):
         else:
             return self.test_attn(batch_data)
 
+    def encode_user_query(self, batch_data):
+        #the candidate item never enters the [query, user-history] sequence,
+        #so each sequence only needs to be encoded once for all its candidates
+        query_word_idxs = batch_data.query_word_idxs
+        u_item_idxs = batch_data.u_item_idxs
+        batch_size, prev_item_count = u_item_idxs.size()
+        query_word_emb = self.word_embeddings(query_word_idxs)
+        query_emb = self.query_encoder(query_word_emb, query_word_idxs.ne(self.word_pad_idx))
+        column_mask = torch.ones(batch_size, 1, dtype=torch.uint8, device=query_word_idxs.device)
+        u_item_mask = u_item_idxs.ne(self.prod_pad_idx)
+        item_seq_mask = torch.cat([column_mask, u_item_mask], dim=1) #batch_size, 1+prev_item_count
+        if self.args.sep_prod_emb:
+            u_item_emb = self.hist_product_emb(u_item_idxs)
+        else:
+            u_item_emb = self.product_emb(u_item_idxs)
+        sequence_emb = torch.cat([query_emb.unsqueeze(1), u_item_emb], dim=1)
+
+        out_pos = -1 if self.args.use_item_pos else 0
+        top_vecs = self.transformer_encoder.encode(sequence_emb, item_seq_mask, use_pos=self.args.use_pos_emb)
+        return top_vecs[:,out_pos,:] #batch_size, embedding_size
+
+    def attend_user_query(self, batch_data):
+        #for QEM, AEM and ZAM the attended user vector does not depend on the candidate either
+        query_word_idxs = batch_data.query_word_idxs
+        u_item_idxs = batch_data.u_item_idxs
+        batch_size, prev_item_count = u_item_idxs.size()
+        query_word_emb = self.word_embeddings(query_word_idxs)
+        query_emb = self.query_encoder(query_word_emb, query_word_idxs.ne(self.word_pad_idx))
+        if self.args.model_name == "QEM":
+            return query_emb
+        embed_size = query_emb.size()[-1]
+        item_seq_mask = u_item_idxs.ne(self.prod_pad_idx)
+        if self.args.sep_prod_emb:
+            sequence_emb = self.hist_product_emb(u_item_idxs)
+        else:
+            sequence_emb = self.product_emb(u_item_idxs)
+        if self.args.model_name == "ZAM":
+            zero_column = torch.zeros(batch_size, 1, embed_size, device=query_word_idxs.device)
+            column_mask = torch.ones(batch_size, 1, dtype=torch.uint8, device=query_word_idxs.device)
+            item_seq_mask = torch.cat([column_mask, item_seq_mask], dim=1)
+            sequence_emb = torch.cat([zero_column, sequence_emb], dim=1)
+        item_seq_mask = item_seq_mask.unsqueeze(1) #batch_size, 1, seq_len
+        out_pos = 0
+        top_vecs = self.attention_encoder(
+                sequence_emb, sequence_emb, query_emb.unsqueeze(1),
+                mask = 1-item_seq_mask)
+        return 0.5 * top_vecs[:,out_pos,:] + 0.5 * query_emb #batch_size, embedding_size
+
+    def score_candidates(self, out_emb, candi_prod_idxs):
+        #out_emb: batch_size, embedding_size; candi_prod_idxs: batch_size, candi_k
+        candi_item_emb = self.product_emb(candi_prod_idxs) #batch_size, candi_k, embedding_size
+        candi_scores = torch.bmm(candi_item_emb, out_emb.unsqueeze(2)).squeeze(2)
+        if self.args.sim_func == "bias_product":
+            candi_scores += self.product_bias[candi_prod_idxs]
+        return candi_scores #batch_size, candi_k
+
+    def test_topk(self, batch_data, cutoff, block_size):
+        #score each (user, query) row against the whole catalog block by block, keeping
+        #only a running top-cutoff and the rank of the target product
+        if self.args.model_name == "item_transformer":
+            out_emb = self.encode_user_query(batch_data)
+        else:
+            out_emb = self.attend_user_query(batch_data)
+        target_prod_idxs = batch_data.target_prod_idxs
+        target_scores = self.score_candidates(out_emb, target_prod_idxs.unsqueeze(1)) #batch_size, 1
+        target_ranks = torch.ones_like(target_prod_idxs)
+        product_size = self.prod_pad_idx
+        topk_scores, topk_idxs = None, None
+        for start in range(0, product_size, block_size):
+            end = min(start + block_size, product_size)
+            block_scores = torch.mm(out_emb, self.product_emb.weight[start:end].t()) #batch_size, block_size
+            if self.args.sim_func == "bias_product":
+                block_scores += self.product_bias[start:end]
+            #ties are broken by product id; the target is left out of its own count so that
+            #rounding differences between the two matrix multiplies can not push it below itself
+            block_prod_idxs = torch.arange(start, end, device=block_scores.device)
+            is_above = (block_scores > target_scores) | \
+                    ((block_scores == target_scores) & block_prod_idxs.lt(target_prod_idxs.unsqueeze(1)))
+            is_above &= block_prod_idxs.ne(target_prod_idxs.unsqueeze(1))
+            target_ranks += is_above.sum(dim=1)
+            block_topk_scores, block_topk_idxs = block_scores.topk(min(cutoff, end - start), dim=1)
+            block_topk_idxs += start
+            if topk_scores is not None:
+                block_topk_scores = torch.cat([topk_scores, block_topk_scores], dim=1)
+                block_topk_idxs = torch.cat([topk_idxs, block_topk_idxs], dim=1)
+            topk_scores, merge_idxs = block_topk_scores.topk(min(cutoff, end), dim=1)
+            topk_idxs = block_topk_idxs.gather(1, merge_idxs)
+        return topk_idxs, topk_scores, target_ranks
+
     def test_dotproduct(self, batch_data):
+        if self.args.encode_once:
+            out_emb = self.encode_user_query(batch_data)
+            return self.score_candidates(out_emb, batch_data.candi_prod_idxs)
         query_word_idxs = batch_data.query_word_idxs
         target_prod_idxs = batch_data.target_prod_idxs
         u_item_idxs = batch_data.u_item_idxs
@@ -183,6 +279,9 @@ class ItemTransformerRanker(nn.Module):
         return candi_scores
 
     def test_attn(self, batch_data):
+        if self.args.encode_once:
+            out_emb = self.attend_user_query(batch_data)
+            return self.score_candidates(out_emb, batch_data.candi_prod_idxs)
         query_word_idxs = batch_data.query_word_idxs
         target_prod_idxs = batch_data.target_prod_idxs
         u_item_idxs = batch_data.u_item_idxs
@@ -301,7 +400,7 @@ class ItemTransformerRanker(nn.Module):
         #for each target word, there is k words negative sampling
         #vocab_size = self.word_embeddings.weight.size() - 1
         #compute the loss of review generating positive and negative words
-        neg_sample_idxs = torch.multinomial(self.word_dists, batch_size * pv_window_size * n_negs, replacement=True)
+        neg_sample_idxs = self.word_sampler.sample(batch_size * pv_window_size * n_negs)
         neg_sample_emb = self.word_embeddings(neg_sample_idxs.view(batch_size,-1))
         output_pos = torch.bmm(target_word_emb, prod_emb.unsqueeze(2)) # batch_size, pv_window_size, 1
         output_neg = torch.bmm(neg_sample_emb, prod_emb.unsqueeze(2)).view(batch_size, pv_window_size, -1)
@@ -329,7 +428,7 @@ class ItemTransformerRanker(nn.Module):
         neg_k = self.args.neg_per_pos
 
         pos_iword_idxs = batch_data.pos_iword_idxs
-        neg_item_idxs = torch.multinomial(self.prod_dists, batch_size * neg_k, replacement=True)
+        neg_item_idxs = self.prod_sampler.sample(batch_size * neg_k)
         neg_item_idxs = neg_item_idxs.view(batch_size, -1)
 
         query_word_emb = self.word_embeddings(query_word_idxs)
@@ -434,7 +533,7 @@ class ItemTransformerRanker(nn.Module):
         neg_k = self.args.neg_per_pos
 
         pos_iword_idxs = batch_data.pos_iword_idxs
-        neg_item_idxs = torch.multinomial(self.prod_dists, batch_size * neg_k, replacement=True)
+        neg_item_idxs = self.prod_sampler.sample(batch_size * neg_k)
         neg_item_idxs = neg_item_idxs.view(batch_size, -1)
 
         query_word_emb = self.word_embeddings(query_word_idxs)
@@ -530,7 +629,62 @@ class ItemTransformerRanker(nn.Module):
 
         return ps_loss + item_loss
 
+    def forward_shared_neg(self, batch_data):
+        #the negatives never enter the [query, history] sequence, so it is encoded once
+        #and scored against the negatives of its row, or a pool shared by the batch, with one matrix multiply
+        target_prod_idxs = batch_data.target_prod_idxs
+        batch_size = target_prod_idxs.size(0)
+        neg_k = self.args.neg_per_pos
+        if self.args.neg_sharing == "row":
+            neg_item_idxs = self.prod_sampler.sample(batch_size * neg_k)
+            neg_item_idxs = neg_item_idxs.view(batch_size, -1)
+        else:
+            pool_size = self.args.neg_pool_size if self.args.neg_pool_size > 0 else batch_size * neg_k
+            neg_item_idxs = self.prod_sampler.sample(pool_size)
+
+        out_emb = self.encode_user_query(batch_data) #batch_size, embedding_size
+        pos_scores = self.score_candidates(out_emb, target_prod_idxs.unsqueeze(1)) #batch_size, 1
+        if self.args.neg_sharing == "row":
+            neg_scores = self.score_candidates(out_emb, neg_item_idxs) #batch_size, neg_k
+        else:
+            neg_scores = torch.mm(out_emb, self.product_emb(neg_item_idxs).t()) #batch_size, pool_size
+            if self.args.sim_func == "bias_product":
+                neg_scores += self.product_bias[neg_item_idxs]
+        neg_mask = torch.ones_like(neg_scores)
+        if self.args.in_batch_neg:
+            #the positives of the other rows, except those of the same item as the row's positive
+            in_batch_scores = torch.mm(out_emb, self.product_emb(target_prod_idxs).t()) #batch_size, batch_size
+            if self.args.sim_func == "bias_product":
+                in_batch_scores += self.product_bias[target_prod_idxs]
+            in_batch_mask = target_prod_idxs.unsqueeze(0).ne(target_prod_idxs.unsqueeze(1)).float()
+            neg_scores = torch.cat([neg_scores, in_batch_scores], dim=-1)
+            neg_mask = torch.cat([neg_mask, in_batch_mask], dim=-1)
+        #the negatives of a row weigh neg_per_pos in total as in forward_dotproduct, however many are scored
+        #(each weighs 1 with row and no in_batch_neg)
+        neg_mask = neg_mask * (neg_k / neg_mask.sum(-1, keepdim=True).clamp(min=1))
+
+        pos_weight = 1
+        if self.args.pos_weight:
+            pos_weight = self.args.neg_per_pos
+        prod_mask = torch.cat([torch.ones_like(pos_scores) * pos_weight, neg_mask], dim=-1)
+        prod_scores = torch.cat([pos_scores, neg_scores], dim=-1)
+        target = torch.cat([torch.ones_like(pos_scores), torch.zeros_like(neg_scores)], dim=-1)
+        ps_loss = nn.functional.binary_cross_entropy_with_logits(
+            prod_scores, target,
+            weight=prod_mask,
+            reduction='none')
+        ps_loss = ps_loss.sum(-1).mean()
+
+        item_loss = self.item_to_words(target_prod_idxs, batch_data.pos_iword_idxs, self.args.neg_per_pos)
+
+        self.ps_loss += ps_loss.item()
+        self.item_loss += item_loss.item()
+
+        return ps_loss + item_loss
+
     def forward_dotproduct(self, batch_data, train_pv=False):
+        if self.args.neg_sharing != "none":
+            return self.forward_shared_neg(batch_data)
 
         query_word_idxs = batch_data.query_word_idxs
         target_prod_idxs = batch_data.target_prod_idxs
@@ -542,7 +696,7 @@ class ItemTransformerRanker(nn.Module):
 
         pos_iword_idxs = batch_data.pos_iword_idxs
 
-        neg_item_idxs = torch.multinomial(self.prod_dists, batch_size * neg_k, replacement=True)
+        neg_item_idxs = self.prod_sampler.sample(batch_size * neg_k)
         neg_item_idxs = neg_item_idxs.view(batch_size, -1)
 
         if self.args.query_encoder_name == "grace_bert_cls":
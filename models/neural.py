@@ -2,6 +2,7 @@ import math
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 def gelu(x):
@@ -83,18 +84,31 @@ class MultiHeadedAttention(nn.Module):
         super(MultiHeadedAttention, self).__init__()
         self.head_count = head_count
 
-        self.linear_keys = nn.Linear(model_dim,
-                                     head_count * self.dim_per_head)
-        self.linear_values = nn.Linear(model_dim,
-                                       head_count * self.dim_per_head)
-        self.linear_query = nn.Linear(model_dim,
-                                      head_count * self.dim_per_head)
+        #query, key and value projections in one matrix, [query; key; value]
+        self.linear_qkv = nn.Linear(model_dim,
+                                    3 * head_count * self.dim_per_head)
         self.softmax = nn.Softmax(dim=-1)
         self.dropout = nn.Dropout(dropout)
         self.use_final_linear = use_final_linear
         if (self.use_final_linear):
             self.final_linear = nn.Linear(model_dim, model_dim)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        #checkpoints saved with separate linear_query, linear_keys and linear_values
+        for param in ["weight", "bias"]:
+            names = [prefix + "linear_%s.%s" % (x, param) for x in ["query", "keys", "values"]]
+            if all(x in state_dict for x in names):
+                state_dict[prefix + "linear_qkv." + param] = torch.cat(
+                    [state_dict.pop(x) for x in names], dim=0)
+        super(MultiHeadedAttention, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+    def project(self, x, i, count=1):
+        """ query (0), key (1) or value (2) projection of x, count projections from i on """
+        size = self.head_count * self.dim_per_head
+        return F.linear(x, self.linear_qkv.weight[i*size:(i+count)*size],
+                        self.linear_qkv.bias[i*size:(i+count)*size])
+
     def forward(self, key, value, query, mask=None,
                 layer_cache=None, type=None, predefined_graph_1=None):
         """
@@ -107,8 +121,8 @@ class MultiHeadedAttention(nn.Module):
                 value vectors `[batch, key_len, dim]`
            query (`FloatTensor`): set of `query_len`
                  query vectors  `[batch, query_len, dim]`
-           mask: binary mask indicating which keys have
-                 non-zero attention `[batch, query_len, key_len]`
+           mask: binary mask indicating which keys are
+                 masked out `[batch, 1, key_len]` or `[batch, query_len, key_len]`
         Returns:
            (`FloatTensor`, `FloatTensor`) :
 
@@ -116,28 +130,9 @@ class MultiHeadedAttention(nn.Module):
            * one of the attention vectors `[batch, query_len, key_len]`
         """
 
-        # CHECKS
-        # batch, k_len, d = key.size()
-        # batch_, k_len_, d_ = value.size()
-        # aeq(batch, batch_)
-        # aeq(k_len, k_len_)
-        # aeq(d, d_)
-        # batch_, q_len, d_ = query.size()
-        # aeq(batch, batch_)
-        # aeq(d, d_)
-        # aeq(self.model_dim % 8, 0)
-        # if mask is not None:
-        #    batch_, q_len_, k_len_ = mask.size()
-        #    aeq(batch_, batch)
-        #    aeq(k_len_, k_len)
-        #    aeq(q_len_ == q_len)
-        # END CHECKS
-
         batch_size = key.size(0)
         dim_per_head = self.dim_per_head
         head_count = self.head_count
-        key_len = key.size(1)
-        query_len = query.size(1)
 
         def shape(x):
             """  projection """
@@ -152,93 +147,94 @@ class MultiHeadedAttention(nn.Module):
         # 1) Project key, value, and query.
         if layer_cache is not None:
             if type == "self":
-                query, key, value = self.linear_query(query), \
-                                    self.linear_keys(query), \
-                                    self.linear_values(query)
+                query, key, value = self.linear_qkv(query).chunk(3, dim=-1)
 
                 key = shape(key)
                 value = shape(value)
 
-                if layer_cache is not None:
-                    device = key.device
-                    if layer_cache["self_keys"] is not None:
-                        key = torch.cat(
-                            (layer_cache["self_keys"].to(device), key),
-                            dim=2)
-                    if layer_cache["self_values"] is not None:
-                        value = torch.cat(
-                            (layer_cache["self_values"].to(device), value),
-                            dim=2)
-                    layer_cache["self_keys"] = key
-                    layer_cache["self_values"] = value
+                device = key.device
+                if layer_cache["self_keys"] is not None:
+                    key = torch.cat(
+                        (layer_cache["self_keys"].to(device), key),
+                        dim=2)
+                if layer_cache["self_values"] is not None:
+                    value = torch.cat(
+                        (layer_cache["self_values"].to(device), value),
+                        dim=2)
+                layer_cache["self_keys"] = key
+                layer_cache["self_values"] = value
             elif type == "context":
-                query = self.linear_query(query)
-                if layer_cache is not None:
-                    if layer_cache["memory_keys"] is None:
-                        key, value = self.linear_keys(key), \
-                                     self.linear_values(value)
-                        key = shape(key)
-                        value = shape(value)
-                    else:
-                        key, value = layer_cache["memory_keys"], \
-                                     layer_cache["memory_values"]
-                    layer_cache["memory_keys"] = key
-                    layer_cache["memory_values"] = value
-                else:
-                    key, value = self.linear_keys(key), \
-                                 self.linear_values(value)
+                query = self.project(query, 0)
+                if layer_cache["memory_keys"] is None:
+                    key, value = self.project(key, 1), \
+                                 self.project(value, 2)
                     key = shape(key)
                     value = shape(value)
+                else:
+                    key, value = layer_cache["memory_keys"], \
+                                 layer_cache["memory_values"]
+                layer_cache["memory_keys"] = key
+                layer_cache["memory_values"] = value
+        elif key is value and value is query:
+            #self attention, one matmul for the three projections
+            query, key, value = self.linear_qkv(query).chunk(3, dim=-1)
+            key = shape(key)
+            value = shape(value)
         else:
-            key = self.linear_keys(key)
-            value = self.linear_values(value)
-            query = self.linear_query(query)
+            query = self.project(query, 0)
+            if key is value:
+                key, value = self.project(key, 1, count=2).chunk(2, dim=-1)
+            else:
+                key, value = self.project(key, 1), self.project(value, 2)
             key = shape(key)
             value = shape(value)
 
         query = shape(query)
-        #batch_size, head_count, max_sent_count, dim_per_head
-
-        key_len = key.size(2)
-        query_len = query.size(2)
-
-        # 2) Calculate and scale scores.
-        query = query / math.sqrt(dim_per_head)
-        scores = torch.matmul(query, key.transpose(2, 3))
-        #batch_size, head_count, query_len, key_len
+        #batch_size, head_count, query_len, dim_per_head
 
         if mask is not None:
-            #mask is (batch_size, 1, key_len)
+            mask = mask.bool()
             if len(mask.size()) == 3:
-                mask = mask.unsqueeze(1).expand_as(scores)
-            scores = scores.masked_fill(mask, -1e18)
+                #mask is (batch_size, 1 or query_len, key_len), broadcast over the heads
+                mask = mask.unsqueeze(1)
+
+        if predefined_graph_1 is None and hasattr(F, "scaled_dot_product_attention"):
+            attn_mask = None
+            if mask is not None:
+                #additive rather than boolean, so that a query with all the keys masked
+                #attends to them uniformly as with the masked_fill below, instead of getting nan
+                attn_mask = torch.zeros(mask.size(), dtype=query.dtype, device=query.device) \
+                    .masked_fill(mask, -1e18)
+            context = F.scaled_dot_product_attention(
+                query, key, value, attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.)
+        else:
+            # 2) Calculate and scale scores.
+            query = query / math.sqrt(dim_per_head)
+            scores = torch.matmul(query, key.transpose(2, 3))
+            #batch_size, head_count, query_len, key_len
+
+            if mask is not None:
+                scores = scores.masked_fill(mask, -1e18)
 
-        # 3) Apply attention dropout and compute context vectors.
+            # 3) Apply attention dropout and compute context vectors.
 
-        attn = self.softmax(scores)
+            attn = self.softmax(scores)
 
-        if (not predefined_graph_1 is None):
-            attn_masked = attn[:, -1] * predefined_graph_1
-            attn_masked = attn_masked / (torch.sum(attn_masked, 2).unsqueeze(2) + 1e-9)
+            if (not predefined_graph_1 is None):
+                attn_masked = attn[:, -1] * predefined_graph_1
+                attn_masked = attn_masked / (torch.sum(attn_masked, 2).unsqueeze(2) + 1e-9)
 
-            attn = torch.cat([attn[:, :-1], attn_masked.unsqueeze(1)], 1)
+                attn = torch.cat([attn[:, :-1], attn_masked.unsqueeze(1)], 1)
+
+            drop_attn = self.dropout(attn)
+            context = torch.matmul(drop_attn, value)
+        #batch_size, head_count, query_len, dim_per_head
 
-        drop_attn = self.dropout(attn)
         if (self.use_final_linear):
-            context = unshape(torch.matmul(drop_attn, value))
+            context = unshape(context)
             #batch_size, query_len, head_count * dim_per_head
             output = self.final_linear(context)
             return output
         else:
-            context = torch.matmul(drop_attn, value)
             return context
-            #batch_size, head_count, query_len, dim_per_head
-
-        # CHECK
-        # batch_, q_len_, d_ = output.size()
-        # aeq(q_len, q_len_)
-        # aeq(batch, batch_)
-        # aeq(d, d_)
-
-        # Return one attn
-
@@ -166,12 +166,16 @@ class Optimizer(object):
         """ ? """
         self.params = []
         self.sparse_params = []
+        self.param_names = [] #names of the params, in the order of the optimizer state
+        self.sparse_param_names = []
         for k, p in params:
             if p.requires_grad:
                 if self.method != 'sparseadam' or "embed" not in k:
                     self.params.append(p)
+                    self.param_names.append(k)
                 else:
                     self.sparse_params.append(p)
+                    self.sparse_param_names.append(k)
         if self.method == 'sgd':
             self.optimizer = optim.SGD(self.params, lr=self.learning_rate, weight_decay=self.weight_decay)
         elif self.method == 'adagrad':
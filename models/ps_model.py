@@ -11,11 +11,49 @@ import torch
 import torch.nn as nn
 from models.PV import ParagraphVector
 from models.PVC import ParagraphVectorCorruption
+from models.sampler import build_sampler
 from models.text_encoder import AVGEncoder, FSEncoder
 from models.transformer import TransformerEncoder
 from models.optimizers import Optimizer
 from others.logging import logger
-from others.util import pad, load_pretrain_embeddings, load_user_item_embeddings
+from others.util import load_pretrain_embeddings, load_user_item_embeddings
+
+def fuse_qkv_optimizer_state(state_dict, names):
+    """ the optimizer state_dict of a checkpoint saved before the query, key and value projections of
+    MultiHeadedAttention were fused into linear_qkv, for the params with names (in the order of the optimizer);
+    the states of the three projections are concatenated in the order of MultiHeadedAttention._load_from_state_dict.
+    state_dict is returned as it is if it already has the params, and None if it does not match them
+    """
+    if len(state_dict['param_groups']) != 1:
+        return None
+    saved_idxs = state_dict['param_groups'][0]['params']
+    if len(saved_idxs) == len(names):
+        return state_dict
+    #the names of the params when the checkpoint was saved, the projections in the order they were defined
+    saved_names = []
+    for name in names:
+        if name.endswith("linear_qkv.weight"):
+            prefix = name[:-len("linear_qkv.weight")]
+            saved_names += [prefix + "linear_%s.%s" % (x, y) for x in ["keys", "values", "query"] for y in ["weight", "bias"]]
+        elif not name.endswith("linear_qkv.bias"):
+            saved_names.append(name)
+    if len(saved_names) != len(saved_idxs):
+        return None
+    saved_states = {name:state_dict['state'].get(idx) for name, idx in zip(saved_names, saved_idxs)}
+    state = {}
+    for idx, name in enumerate(names):
+        if "linear_qkv." in name:
+            prefix, param = name.rsplit("linear_qkv.", 1)
+            states = [saved_states[prefix + "linear_%s.%s" % (x, param)] for x in ["query", "keys", "values"]]
+            if None in states: #no steps taken yet
+                continue
+            #exp_avg, exp_avg_sq etc. are concatenated like the weights; step is the same for the three
+            state[idx] = {k:torch.cat([x[k] for x in states], dim=0) if torch.is_tensor(v) and v.dim() > 0 else v
+                    for k, v in states[0].items()}
+        elif saved_states[name] is not None:
+            state[idx] = saved_states[name]
+    param_group = dict(state_dict['param_groups'][0], params=list(range(len(names))))
+    return {'state':state, 'param_groups':[param_group]}
 
 def build_optim(args, model, checkpoint):
     """ Build optimizer """
@@ -36,17 +74,29 @@ def build_optim(args, model, checkpoint):
     optim.set_parameters(list(model.named_parameters()))
 
     if args.train_from != '' and checkpoint is not None:
-        optim.optimizer.load_state_dict(saved_optimizer_state_dict)
-        if args.device == "cuda":
-            for state in optim.optimizer.state.values():
-                for k, v in state.items():
-                    if torch.is_tensor(v):
-                        state[k] = v.cuda()
-
-        if (optim.method == 'adam') and (len(optim.optimizer.state) < 1):
-            raise RuntimeError(
-                "Error: loaded Adam optimizer from existing model" +
-                " but optimizer state is empty")
+        if optim.method == 'sparseadam':
+            saved_optimizer_state_dict = [fuse_qkv_optimizer_state(state_dict, names)
+                    for state_dict, names in zip(saved_optimizer_state_dict,
+                        [optim.param_names, optim.sparse_param_names])]
+            if None in saved_optimizer_state_dict:
+                saved_optimizer_state_dict = None
+        else:
+            saved_optimizer_state_dict = fuse_qkv_optimizer_state(saved_optimizer_state_dict, optim.param_names)
+        if saved_optimizer_state_dict is None:
+            logger.warning("The optimizer state of %s does not match the parameters of the model, "
+                    "training continues with a new optimizer state" % args.train_from)
+        else:
+            optim.optimizer.load_state_dict(saved_optimizer_state_dict)
+            if args.device == "cuda":
+                for state in optim.optimizer.state.values():
+                    for k, v in state.items():
+                        if torch.is_tensor(v):
+                            state[k] = v.cuda()
+
+            if (optim.method == 'adam') and (len(optim.optimizer.state) < 1):
+                raise RuntimeError(
+                    "Error: loaded Adam optimizer from existing model" +
+                    " but optimizer state is empty")
 
     return optim
 
@@ -63,6 +113,7 @@ class ProductRanker(nn.Module):
         self.word_dists = None
         if word_dists is not None:
             self.word_dists = torch.tensor(word_dists, device=device)
+        self.word_sampler = build_sampler(args.neg_sampler, self.word_dists)
         self.prod_pad_idx = product_size
         self.user_pad_idx = user_size
         self.word_pad_idx = vocab_size - 1
@@ -75,8 +126,9 @@ class ProductRanker(nn.Module):
         padded_review_words = review_words
         if not self.args.do_subsample_mask:
             #otherwise, review_words should be already padded
-            padded_review_words = pad(review_words, pad_id=self.word_pad_idx, width=args.review_word_limit)
-        self.review_words = torch.tensor(padded_review_words, device=device)
+            padded_review_words = review_words.to_padded(pad_id=self.word_pad_idx, width=args.review_word_limit)
+        self.review_words = torch.tensor(padded_review_words, dtype=torch.long, device=device)
+        self.review_lengths = self.review_words.ne(self.word_pad_idx).sum(-1) #words are padded at the end
 
         self.pretrain_emb_dir = None
         if os.path.exists(args.pretrain_emb_dir):
@@ -136,14 +188,14 @@ class ProductRanker(nn.Module):
             if self.pretrain_emb_dir is not None:
                 pretrain_emb_path = os.path.join(self.pretrain_emb_dir, "doc_emb.txt.gz")
             self.review_encoder = ParagraphVector(
-                    self.word_embeddings, self.word_dists,
+                    self.word_embeddings, self.word_sampler,
                     review_count, self.emb_dropout, pretrain_emb_path, fix_emb=self.fix_emb)
         elif self.review_encoder_name == "pvc":
             pretrain_emb_path = None
             #if self.pretrain_emb_dir is not None:
             #    pretrain_emb_path = os.path.join(self.pretrain_emb_dir, "context_emb.txt.gz")
             self.review_encoder = ParagraphVectorCorruption(
-                    self.word_embeddings, self.word_dists, args.corrupt_rate,
+                    self.word_embeddings, self.word_sampler, args.corrupt_rate,
                     self.emb_dropout, pretrain_emb_path, self.vocab_words, fix_emb=self.fix_emb)
         elif self.review_encoder_name == "fs":
             self.review_encoder = FSEncoder(self.embedding_size, self.emb_dropout)
@@ -191,8 +243,17 @@ class ProductRanker(nn.Module):
             seg_count = int((review_count - 1) / batch_size) + 1
             self.review_embeddings = torch.zeros(review_count+1, self.embedding_size, device=self.device)
             #The last one is always 0
+            review_order = None
+            if self.args.trim_review_words: #encode reviews of similar lengths together, without the padding after them
+                review_order = torch.argsort(self.review_lengths[:review_count])
             for i in range(seg_count):
-                slice_reviews = self.review_words[i*batch_size:(i+1)*batch_size]
+                if review_order is None:
+                    slice_idxs = slice(i*batch_size, (i+1)*batch_size)
+                    slice_reviews = self.review_words[slice_idxs]
+                else:
+                    slice_idxs = review_order[i*batch_size:(i+1)*batch_size]
+                    word_limit = max(1, self.review_lengths[slice_idxs].max().item())
+                    slice_reviews = self.review_words[slice_idxs, :word_limit]
                 if self.review_encoder_name == "pvc":
                     self.review_encoder.set_to_evaluation_mode()
                     slice_review_emb = self.review_encoder.get_para_vector(slice_reviews)
@@ -200,7 +261,7 @@ class ProductRanker(nn.Module):
                 else: #fs or avg
                     slice_rword_emb = self.word_embeddings(slice_reviews)
                     slice_review_emb = self.review_encoder(slice_rword_emb, slice_reviews.ne(self.word_pad_idx))
-                self.review_embeddings[i*batch_size:(i+1)*batch_size] = slice_review_emb
+                self.review_embeddings[slice_idxs] = slice_review_emb
 
     def test(self, batch_data):
         query_word_idxs = batch_data.query_word_idxs
@@ -0,0 +1,53 @@
+""" negative samplers over word and product distributions
+    multinomial: torch.multinomial over the weights on each draw
+    alias: Walker's alias tables built once, then two uniform numbers per sample
+"""
+import numpy as np
+import torch
+
+def build_sampler(name, weights, device=None):
+    if weights is None:
+        return None
+    if name == "alias":
+        return AliasSampler(weights, device)
+    return MultinomialSampler(weights, device)
+
+class MultinomialSampler(object):
+    def __init__(self, weights, device=None):
+        self.weights = torch.as_tensor(weights, device=device)
+
+    def sample(self, count):
+        return torch.multinomial(self.weights, count, replacement=True)
+
+class AliasSampler(object):
+    def __init__(self, weights, device=None):
+        weights = torch.as_tensor(weights)
+        if device is None:
+            device = weights.device
+        prob, alias = self.build_tables(weights.detach().cpu().double().numpy())
+        self.size = len(prob)
+        self.prob = torch.tensor(prob, dtype=torch.float, device=device)
+        self.alias = torch.tensor(alias, dtype=torch.long, device=device)
+
+    @staticmethod
+    def build_tables(weights):
+        #Vose's method: each column i is kept with probability prob[i], otherwise alias[i] is drawn
+        size = len(weights)
+        scaled = weights * size / weights.sum()
+        prob = np.ones(size)
+        alias = np.arange(size)
+        small = np.flatnonzero(scaled < 1.).tolist()
+        large = np.flatnonzero(scaled >= 1.).tolist()
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1. - scaled[s]
+            (small if scaled[l] < 1. else large).append(l)
+        #the columns left are full up to rounding errors
+        return prob, alias
+
+    def sample(self, count):
+        idxs = torch.randint(self.size, (count,), device=self.prob.device)
+        keep = torch.rand(count, device=self.prob.device) < self.prob[idxs]
+        return torch.where(keep, idxs, self.alias[idxs])
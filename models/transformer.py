@@ -80,8 +80,9 @@ class TransformerEncoder(nn.Module):
             pos_emb = self.pos_emb.pe[:, :n_sents]
             x = x + pos_emb
 
+        padding_mask = ~mask.bool() #the padded positions, shared by the layers
         for i in range(self.num_inter_layers):
-            x = self.transformer_inter[i](i, x, x, 1 - mask)  # all_sents * max_tokens * dim
+            x = self.transformer_inter[i](i, x, x, padding_mask)  # all_sents * max_tokens * dim
 
         x = self.layer_norm(x)
         #out_pos can be 0 or -1 # represent query or item in the item_transformer model
@@ -101,7 +102,14 @@ class TransformerEncoder(nn.Module):
         if logger:
             logger.info(" Transformer initialization started.")
         for name, p in self.named_parameters():
-            if "weight" in name and p.dim() > 1:
+            if "linear_qkv.weight" in name:
+                if logger:
+                    logger.info(" {} ({}): Xavier normal init per projection.".format(
+                        name, ",".join([str(x) for x in p.size()])))
+                #the same scale as the separate query, key and value matrices
+                for w in p.data.chunk(3, dim=0):
+                    nn.init.xavier_normal_(w)
+            elif "weight" in name and p.dim() > 1:
                 if logger:
                     logger.info(" {} ({}): Xavier normal init.".format(
                         name, ",".join([str(x) for x in p.size()])))
@@ -1,4 +1,6 @@
 import gzip
+import itertools
+import numpy as np
 from others.logging import logger
 
 def load_pretrain_embeddings(fname):
@@ -33,60 +35,42 @@ def load_user_item_embeddings(fname):
     logger.info("Count:{} Embeddings size:{}".format(len(embeddings), len(embeddings[0])))
     return embeddings
 
-def pad(data, pad_id, width=-1):
+def pad_csr(offsets, values, pad_id, width=-1, dtype=None):
+    #(len(offsets)-1, width) array of the rows values[offsets[i]:offsets[i+1]], cut or padded with pad_id
+    offsets = np.asarray(offsets, dtype=np.int64)
+    values = np.asarray(values)
+    lengths = np.diff(offsets)
     if (width == -1):
-        width = max(len(d) for d in data)
-    rtn_data = [d[:width] + [pad_id] * (width - len(d)) for d in data]#if width < max(len(d)) of data
+        width = lengths.max() if len(lengths) > 0 else 0
+    rtn_data = np.full((len(lengths), width), pad_id, dtype=values.dtype if dtype is None else dtype)
+    row_idxs = np.repeat(np.arange(len(lengths)), lengths)
+    col_idxs = np.arange(len(row_idxs)) - np.repeat(offsets[:-1] - offsets[0], lengths)
+    keep = col_idxs < width
+    rtn_data[row_idxs[keep], col_idxs[keep]] = values[offsets[0]:offsets[-1]][keep]
     return rtn_data
 
-def pad_3d(data, pad_id, dim=1, width=-1):
-    #dim = 1 or 2
-    if dim < 1 or dim > 2:
-        return data
-    if (width == -1):
-        if (dim == 1):
-            #dim 0,2 is same across the batch
-            width = max(len(d) for d in data)
-        elif (dim == 2):
-            #dim 0,1 is same across the batch
-            for entry in data:
-                width = max(width, max(len(d) for d in entry))
-        #print(width)
-    if dim == 1:
-        rtn_data = [d[:width] + [[pad_id] * len(data[0][0])] * (width - len(d)) for d in data]
-    elif dim == 2:
-        rtn_data = []
-        for entry in data:
-            rtn_data.append([d[:width] + [pad_id] * (width - len(d)) for d in entry])
-    return rtn_data
+def ragged_to_csr(data, dtype=np.int64):
+    #offsets and values of a list of lists (or 1-d arrays)
+    lengths = np.fromiter((len(d) for d in data), dtype=np.int64, count=len(data))
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter(itertools.chain.from_iterable(data), dtype=dtype, count=offsets[-1])
+    return offsets, values
 
-def pad_4d_dim1(data, pad_id, width=-1):
-    if (width == -1):
-        #max width of dim1
-        width = max(width, max(len(d) for d in data))
-    #print(width)
-    rtn_data = [d[:width] + [[[pad_id] * len(data[0][0][0])]] * (width - len(d)) for d in data]
-    return rtn_data
+def pad_array(data, pad_id, width=-1, dtype=np.int64):
+    #batch_size, width
+    offsets, values = ragged_to_csr(data, dtype)
+    return pad_csr(offsets, values, pad_id, width=width, dtype=dtype)
 
-def pad_4d_dim2(data, pad_id, width=-1):
-    #only handle padding to dim = 2
-    if (width == -1):
-        #max width of dim2
-        for entry in data:
-            width = max(width, max(len(d) for d in entry))
-    #print(width)
-    rtn_data = []
-    for entry_dim1 in data:
-        rtn_data.append([d[:width] + [[pad_id] * len(data[0][0][0])] * (width - len(d)) for d in entry_dim1])
+def pad_3d_array(data, pad_id, width1=-1, width2=-1, dtype=np.int64):
+    #batch_size, width1, width2; pads both inner dimensions at once
+    counts = np.fromiter((len(d) for d in data), dtype=np.int64, count=len(data))
+    if (width1 == -1):
+        width1 = counts.max() if len(counts) > 0 else 0
+    rows = pad_array(list(itertools.chain.from_iterable(data)), pad_id, width=width2, dtype=dtype)
+    rtn_data = np.full((len(data), width1, rows.shape[1]), pad_id, dtype=dtype)
+    entry_idxs = np.repeat(np.arange(len(data)), counts)
+    row_nos = np.arange(len(entry_idxs)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = row_nos < width1
+    rtn_data[entry_idxs[keep], row_nos[keep]] = rows[keep]
     return rtn_data
-
-def main():
-    data = [[[[2,2,2],[2,2,2]],[[2,2,2]]],[[[2,2,2]]]]
-    rtn = pad_4d_dim1(data, -1)
-    rtn = pad_4d_dim2(rtn, -1)
-    print(rtn)
-
-if __name__ == "__main__":
-    main()
-
-
@@ -14,6 +14,63 @@ def _tally_parameters(model):
     n_params = sum([p.nelement() for p in model.parameters()])
     return n_params
 
+class TopKAccumulator(object):
+    """
+    Keep the top cutoff candidates and the rank of the target for each (user, query),
+    whose candidate segments arrive in consecutive rows.
+    """
+    def __init__(self, cutoff, product_size):
+        self.cutoff = cutoff
+        self.product_size = product_size
+        self.cur_key = None
+        self.cur_target = None
+        self.cur_prod_idxs, self.cur_prod_scores = [], []
+        self.all_topk_idxs, self.all_topk_scores, self.all_target_ranks = [], [], []
+        self.all_user_idxs, self.all_query_idxs = [], []
+
+    def add(self, user_idxs, query_idxs, target_prod_idxs, candi_prod_idxs, candi_scores):
+        for i in range(len(user_idxs)):
+            key = (user_idxs[i], query_idxs[i])
+            if key != self.cur_key:
+                self.flush()
+                self.cur_key = key
+                self.cur_target = target_prod_idxs[i]
+            #padded candidates are not products
+            is_prod = (candi_prod_idxs[i] >= 0) & (candi_prod_idxs[i] < self.product_size)
+            self.cur_prod_idxs.append(candi_prod_idxs[i][is_prod])
+            self.cur_prod_scores.append(candi_scores[i][is_prod])
+
+    def flush(self):
+        if self.cur_key is None:
+            return
+        prod_idxs = np.concatenate(self.cur_prod_idxs)
+        prod_scores = np.concatenate(self.cur_prod_scores)
+        target_pos = np.where(prod_idxs == self.cur_target)[0]
+        target_rank = 0 #not in the candidates
+        if len(target_pos) > 0:
+            #ties are broken by candidate order, the same way as the ranked list below
+            target_pos = target_pos[0]
+            target_score = prod_scores[target_pos]
+            target_rank = 1 + (prod_scores > target_score).sum() \
+                    + (prod_scores[:target_pos] == target_score).sum()
+        if 0 < self.cutoff < len(prod_scores):
+            top_pos = np.argpartition(-prod_scores, self.cutoff-1)[:self.cutoff]
+        else:
+            top_pos = np.arange(len(prod_scores))
+        top_pos = top_pos[np.argsort(-prod_scores[top_pos], kind='stable')]
+        self.all_topk_idxs.append(prod_idxs[top_pos])
+        self.all_topk_scores.append(prod_scores[top_pos])
+        self.all_target_ranks.append(target_rank)
+        self.all_user_idxs.append(self.cur_key[0])
+        self.all_query_idxs.append(self.cur_key[1])
+        self.cur_key = None
+        self.cur_prod_idxs, self.cur_prod_scores = [], []
+
+    def results(self):
+        self.flush()
+        return self.all_topk_idxs, self.all_topk_scores, np.asarray(self.all_target_ranks), \
+                np.asarray(self.all_query_idxs), np.asarray(self.all_user_idxs)
+
 class Trainer(object):
     """
     Class that controls the training process.
@@ -48,16 +105,26 @@ class Trainer(object):
         current_step = 0
         best_mrr = 0.
         best_checkpoint_path = ''
+        pipeline, dataloader, loader_pv = None, None, None
+        if args.pipeline_epochs:
+            pipeline = data.EpochPipeline(args, self.ExpDataset, global_data, train_prod_data)
         for current_epoch in range(args.start_epoch+1, args.max_train_epoch+1):
             self.model.train()
             logger.info("Initialize epoch:%d" % current_epoch)
-            train_prod_data.initialize_epoch()
-            dataset = self.ExpDataset(args, global_data, train_prod_data)
             prepare_pv = current_epoch < args.train_pv_epoch+1
             print(prepare_pv)
-            dataloader = self.ExpDataloader(
-                    args, dataset, prepare_pv=prepare_pv, batch_size=args.batch_size,
-                    shuffle=True, num_workers=args.num_workers)
+            if pipeline is None:
+                train_prod_data.initialize_epoch()
+                dataset = self.ExpDataset(args, global_data, train_prod_data)
+                dataloader = self.get_train_dataloader(args, dataset, prepare_pv)
+            else:
+                dataset = pipeline.get_dataset(current_epoch)
+                if current_epoch < args.max_train_epoch:
+                    pipeline.start(current_epoch+1) #built while this epoch trains
+                if dataloader is None or loader_pv != prepare_pv: #the workers are kept until prepare_pv changes
+                    dataloader = self.get_train_dataloader(
+                            args, dataset, prepare_pv, persistent_workers=args.num_workers > 0)
+                    loader_pv = prepare_pv
             pbar = tqdm(dataloader)
             pbar.set_description("[Epoch {}]".format(current_epoch))
             time_flag = time.time()
@@ -109,6 +176,16 @@ class Trainer(object):
                 shutil.copyfile(checkpoint_path, best_checkpoint_path)
         return best_checkpoint_path
 
+    def get_train_dataloader(self, args, dataset, prepare_pv, persistent_workers=False):
+        if args.token_budget > 0: #batches of samples with similar lengths
+            batch_args = {"batch_sampler": data.BucketBatchSampler(dataset, args.token_budget, args.batch_size)}
+        elif dataset.epoch_data is not None: #pipelined epochs
+            batch_args = {"batch_size": args.batch_size, "sampler": data.EpochSampler(dataset)}
+        else:
+            batch_args = {"batch_size": args.batch_size, "shuffle": True}
+        return self.ExpDataloader(args, dataset, prepare_pv=prepare_pv, num_workers=args.num_workers,
+                persistent_workers=persistent_workers, **batch_args)
+
     def _save(self, epoch, checkpoint_path):
         checkpoint = {
             'epoch': epoch,
@@ -124,104 +201,117 @@ class Trainer(object):
     def validate(self, args, global_data, valid_dataset):
         """ Validate model.
         """
-        candidate_size = args.valid_candi_size
-        if args.valid_candi_size < 1:
-            candidate_size = global_data.product_size
         dataloader = self.ExpDataloader(
                 args, valid_dataset, batch_size=args.valid_batch_size,
                 shuffle=False, num_workers=args.num_workers)
-        all_prod_idxs, all_prod_scores, all_target_idxs, \
-                all_query_idxs, all_user_idxs \
-                = self.get_prod_scores(args, global_data, valid_dataset, dataloader, "Validation", candidate_size)
-        sorted_prod_idxs = all_prod_scores.argsort(axis=-1)[:,::-1] #by default axis=-1, along the last axis
-        mrr, prec = self.calc_metrics(all_prod_idxs, sorted_prod_idxs, all_target_idxs, candidate_size, cutoff=100)
+        if valid_dataset.catalog_topk:
+            get_prod_scores = self.get_topk_prod_scores
+        else:
+            get_prod_scores = self.get_prod_scores
+        _, _, all_target_ranks, _, _ = get_prod_scores(
+                args, global_data, dataloader, "Validation", cutoff=100)
+        mrr, prec = self.calc_metrics(all_target_ranks, cutoff=100)
         return mrr, prec
 
     def test(self, args, global_data, test_prod_data, rankfname="test.best_model.ranklist", cutoff=100):
-        candidate_size = args.test_candi_size
-        if args.test_candi_size < 1:
-            candidate_size = global_data.product_size
         test_dataset = self.ExpDataset(args, global_data, test_prod_data)
         dataloader = self.ExpDataloader(
                 args, test_dataset, batch_size=args.valid_batch_size, #batch_size
                 shuffle=False, num_workers=args.num_workers)
-
-        all_prod_idxs, all_prod_scores, all_target_idxs, \
+        if test_dataset.catalog_topk:
+            get_prod_scores = self.get_topk_prod_scores
+        else:
+            get_prod_scores = self.get_prod_scores
+        ranked_prod_idxs, ranked_prod_scores, all_target_ranks, \
                 all_query_idxs, all_user_idxs \
-                = self.get_prod_scores(args, global_data, test_dataset, dataloader, "Test", candidate_size)
-        sorted_prod_idxs = all_prod_scores.argsort(axis=-1)[:,::-1] #by default axis=-1, along the last axis
-        mrr, prec = self.calc_metrics(all_prod_idxs, sorted_prod_idxs, all_target_idxs, candidate_size, cutoff)
+                = get_prod_scores(args, global_data, dataloader, "Test", cutoff)
+        mrr, prec = self.calc_metrics(all_target_ranks, cutoff)
         logger.info("Test: MRR:{} P@1:{}".format(mrr, prec))
         output_path = os.path.join(args.save_dir, rankfname)
-        eval_count = all_prod_scores.shape[0]
-        print(all_prod_scores.shape)
+        eval_count = len(ranked_prod_idxs)
         with open(output_path, 'w') as rank_fout:
             for i in range(eval_count):
                 user_id = global_data.user_ids[all_user_idxs[i]]
                 qidx = all_query_idxs[i]
-                ranked_product_ids = all_prod_idxs[i][sorted_prod_idxs[i]]
-                ranked_product_scores = all_prod_scores[i][sorted_prod_idxs[i]]
-                for rank in range(min(cutoff, candidate_size)):
-                    product_id = global_data.product_ids[ranked_product_ids[rank]]
-                    score = ranked_product_scores[rank]
+                for rank in range(len(ranked_prod_idxs[i])):
+                    product_id = global_data.product_ids[ranked_prod_idxs[i][rank]]
+                    score = ranked_prod_scores[i][rank]
                     line = "%s_%d Q0 %s %d %f ReviewTransformer\n" \
                             % (user_id, qidx, product_id, rank+1, score)
                     rank_fout.write(line)
 
-    def calc_metrics(self, all_prod_idxs, sorted_prod_idxs, all_target_idxs, candidate_size, cutoff=100):
-        eval_count = all_prod_idxs.shape[0]
-        mrr, prec = 0, 0
-        for i in range(eval_count):
-            result = np.where(all_prod_idxs[i][sorted_prod_idxs[i]] == all_target_idxs[i])
-            if len(result[0]) == 0: #not occur in the list
-                pass
-            else:
-                rank = result[0][0] + 1
-                if cutoff < 0 or rank <= cutoff:
-                    mrr += 1/rank
-                if rank == 1:
-                    prec +=1
-        mrr /= eval_count
-        prec /= eval_count
+    def calc_metrics(self, all_target_ranks, cutoff=100):
+        #ranks start from 1; 0 means the target is not among the candidates
+        all_target_ranks = np.asarray(all_target_ranks)
+        reciprocal_ranks = np.zeros(len(all_target_ranks))
+        hit = all_target_ranks > 0
+        if cutoff >= 0:
+            hit &= all_target_ranks <= cutoff
+        reciprocal_ranks[hit] = 1. / all_target_ranks[hit]
+        mrr = reciprocal_ranks.mean()
+        prec = (all_target_ranks == 1).mean()
         print("MRR:{} P@1:{}".format(mrr, prec))
+        #there is a single relevant product per (user, query), so recall@k is its hit rate
+        #and the ideal DCG is 1
+        metric_strs = []
+        for k in self.args.eval_cutoffs:
+            in_k = (all_target_ranks > 0) & (all_target_ranks <= k)
+            ndcg = np.zeros(len(all_target_ranks))
+            ndcg[in_k] = 1. / np.log2(all_target_ranks[in_k] + 1)
+            metric_strs.append("NDCG@{}:{:.5f} Recall@{}:{:.5f}".format(k, ndcg.mean(), k, in_k.mean()))
+        if len(metric_strs) > 0:
+            logger.info(" ".join(metric_strs))
         return mrr, prec
 
-    def get_prod_scores(self, args, global_data, dataset, dataloader, description, candidate_size):
+    def get_topk_prod_scores(self, args, global_data, dataloader, description, cutoff):
+        #one row per (user, query); the model scores the whole catalog in blocks
+        #and only the top cutoff products of each row are kept
+        if cutoff < 0:
+            cutoff = global_data.product_size
         self.model.eval()
+        with torch.no_grad():
+            pbar = tqdm(dataloader)
+            pbar.set_description(description)
+            all_topk_idxs, all_topk_scores, all_target_ranks = [], [], []
+            all_user_idxs, all_query_idxs = [], []
+            for batch_data in pbar:
+                batch_data = batch_data.to(args.device)
+                topk_idxs, topk_scores, target_ranks = self.model.test_topk(
+                        batch_data, cutoff, args.catalog_block_size)
+                all_user_idxs.append(np.asarray(batch_data.user_idxs))
+                all_query_idxs.append(np.asarray(batch_data.query_idxs))
+                all_topk_idxs.append(topk_idxs.cpu().numpy())
+                all_topk_scores.append(topk_scores.cpu().numpy())
+                all_target_ranks.append(target_ranks.cpu().numpy())
+        all_topk_idxs = np.concatenate(all_topk_idxs, axis=0)
+        all_topk_scores = np.concatenate(all_topk_scores, axis=0)
+        all_target_ranks = np.concatenate(all_target_ranks, axis=0)
+        all_user_idxs = np.concatenate(all_user_idxs, axis=0)
+        all_query_idxs = np.concatenate(all_query_idxs, axis=0)
+        return all_topk_idxs, all_topk_scores, all_target_ranks, all_query_idxs, all_user_idxs
+
+    def get_prod_scores(self, args, global_data, dataloader, description, cutoff):
+        #the candi_batch_size segments of each (user, query) come in consecutive rows and
+        #are merged into its top cutoff products as they arrive
+        self.model.eval()
+        accumulator = TopKAccumulator(cutoff, global_data.product_size)
         with torch.no_grad():
             if args.model_name == "review_transformer":
                 self.model.get_review_embeddings() #get model.review_embeddings
             pbar = tqdm(dataloader)
             pbar.set_description(description)
-            seg_count = int((candidate_size - 1) / args.candi_batch_size) + 1
-            all_prod_scores, all_target_idxs, all_prod_idxs = [], [], []
-            all_user_idxs, all_query_idxs = [], []
             for batch_data in pbar:
                 batch_data = batch_data.to(args.device)
                 batch_scores = self.model.test(batch_data)
                 #batch_size, candidate_batch_size
-                all_user_idxs.append(np.asarray(batch_data.user_idxs))
-                all_query_idxs.append(np.asarray(batch_data.query_idxs))
                 candi_prod_idxs = batch_data.candi_prod_idxs
                 if type(candi_prod_idxs) is torch.Tensor:
                     candi_prod_idxs = candi_prod_idxs.cpu()
-                all_prod_idxs.append(np.asarray(candi_prod_idxs))
-                all_prod_scores.append(batch_scores.cpu().numpy())
                 target_prod_idxs = batch_data.target_prod_idxs
                 if type(target_prod_idxs) is torch.Tensor:
                     target_prod_idxs = target_prod_idxs.cpu()
-                all_target_idxs.append(np.asarray(target_prod_idxs))
-                #use MRR
-        assert args.candi_batch_size <= candidate_size #otherwise results are wrong
-        padded_length = seg_count * args.candi_batch_size
-        all_prod_idxs = np.concatenate(all_prod_idxs, axis=0).reshape(-1, padded_length)[:, :candidate_size]
-        all_prod_scores = np.concatenate(all_prod_scores, axis=0).reshape(-1, padded_length)[:, :candidate_size]
-        all_target_idxs = np.concatenate(all_target_idxs, axis=0).reshape(-1, seg_count)[:,0]
-        all_user_idxs = np.concatenate(all_user_idxs, axis=0).reshape(-1, seg_count)[:,0]
-        all_query_idxs = np.concatenate(all_query_idxs, axis=0).reshape(-1, seg_count)[:,0]
-        #target_scores = all_prod_scores[np.arange(eval_count), all_target_idxs]
-        #all_prod_scores.sort(axis=-1) #ascending
+                accumulator.add(np.asarray(batch_data.user_idxs), np.asarray(batch_data.query_idxs),
+                        np.asarray(target_prod_idxs), np.asarray(candi_prod_idxs), batch_scores.cpu().numpy())
         if args.model_name == "review_transformer":
             self.model.clear_review_embbeddings()
-        return all_prod_idxs, all_prod_scores, all_target_idxs, all_query_idxs, all_user_idxs
-
+        return accumulator.results()